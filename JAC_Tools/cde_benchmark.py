@@ -0,0 +1,132 @@
+import argparse
+import csv
+import json
+import platform
+import time
+import warnings
+import numpy as np
+from JAC_Tools.cde_models import CDE_Modelling
+
+#parameter regimes covering small and large cores, long and short tails and a grazing transit
+REGIMES={
+    "tiny_core":dict(prr=0.01,dtr=40),
+    "large_core":dict(prr=0.3,dtr=5),
+    "long_tail":dict(prr=0.1,dtr=60),
+    "short_tail":dict(prr=0.1,dtr=3),
+    "grazing":dict(prr=0.1,dtr=20,ipr=0.95),
+}
+FIELDS=["method","backend","regime","frame_steps","time_steps","seconds","max_error","rms_error"]
+
+def run_benchmark(methods=("quick","slice","full"),backends=("numpy","windowed","adaptive"),frame_steps_values=(20,50,100),time_steps_values=(100,300),regimes=None,reference_frame_steps=400,repeats=3,time_span=0.1):
+    """
+        Time each lightcurve method and backend over a matrix of frame_steps, len(t) and parameter regimes.
+
+        Every lightcurve is compared with a high resolution full_lightcurve (reference_frame_steps) of the same regime and times, and the
+        best of repeats runs is recorded. Returns a list of dictionaries with the keys in FIELDS. The quick lightcurve has no frame_steps
+        so it is only run once for each len(t), with frame_steps recorded as 1.
+    """
+    if regimes is None:
+        regimes=REGIMES
+    rows=[]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore",RuntimeWarning)
+        for regime,params in regimes.items():
+            for time_steps in time_steps_values:
+                t=np.linspace(-time_span,time_span,time_steps)
+                reference=CDE_Modelling(**params).full_lightcurve(t,reference_frame_steps,backend="windowed")
+                for method in methods:
+                    for backend in backends:
+                        for frame_steps in ((1,) if method=="quick" else frame_steps_values):
+                            seconds=np.inf
+                            for repeat in range(repeats):
+                                model=CDE_Modelling(**params)
+                                start=time.perf_counter()
+                                if method=="quick":
+                                    cde_lightcurve=model.quick_lightcurve(t,backend=backend)
+                                else:
+                                    cde_lightcurve=getattr(model,method+"_lightcurve")(t,frame_steps,backend=backend)
+                                seconds=min(seconds,time.perf_counter()-start)
+                            error=cde_lightcurve-reference
+                            rows.append({"method":method,"backend":backend,"regime":regime,"frame_steps":frame_steps,"time_steps":time_steps,
+                                         "seconds":seconds,"max_error":float(np.max(np.abs(error))),"rms_error":float(np.sqrt(np.mean(error**2)))})
+    return rows
+
+def write_results(rows,path):
+    """
+        Write benchmark results to a .json file (along with the python and numpy versions) or to a .csv file.
+    """
+    if path.endswith(".csv"):
+        with open(path,"w",newline="") as results_file:
+            writer=csv.DictWriter(results_file,fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path,"w") as results_file:
+            json.dump({"python":platform.python_version(),"numpy":np.__version__,"results":rows},results_file,indent=1)
+
+def read_results(path):
+    """
+        Read benchmark results written by write_results.
+    """
+    if path.endswith(".csv"):
+        with open(path,newline="") as results_file:
+            rows=list(csv.DictReader(results_file))
+        for row in rows:
+            for field in ("frame_steps","time_steps"):
+                row[field]=int(row[field])
+            for field in ("seconds","max_error","rms_error"):
+                row[field]=float(row[field])
+        return rows
+    with open(path) as results_file:
+        return json.load(results_file)["results"]
+
+def compare_results(old_rows,new_rows,time_ratio=1.25,error_ratio=1.5,time_floor=1e-3,error_floor=1e-6):
+    """
+        Find the benchmarks which have become slower or less accurate between two runs.
+
+        A benchmark is a regression if it takes more than time_ratio times as long, or if its max_error has grown by more than error_ratio
+        (times below time_floor seconds and errors below error_floor are ignored as noise). Returns a list of (key,field,old value,new value) where key is
+        (method,backend,regime,frame_steps,time_steps).
+    """
+    key_fields=FIELDS[:5]
+    old_results={tuple(row[field] for field in key_fields):row for row in old_rows}
+    regressions=[]
+    for row in new_rows:
+        key=tuple(row[field] for field in key_fields)
+        if key not in old_results:
+            continue
+        old=old_results[key]
+        if row["seconds"]>max(time_ratio*old["seconds"],time_floor):
+            regressions.append((key,"seconds",old["seconds"],row["seconds"]))
+        if row["max_error"]>max(error_ratio*old["max_error"],error_floor):
+            regressions.append((key,"max_error",old["max_error"],row["max_error"]))
+    return regressions
+
+def main(arguments=None):
+    """
+        Command line entry point, run with python -m JAC_Tools.cde_benchmark --help for the options.
+    """
+    parser=argparse.ArgumentParser(description="Benchmark the runtime and accuracy of the CDE lightcurve models.")
+    parser.add_argument("--output",default="cde_benchmark.json",help="results file, .json or .csv")
+    parser.add_argument("--compare",help="previous results file to check for regressions against")
+    parser.add_argument("--methods",nargs="+",default=["quick","slice","full"])
+    parser.add_argument("--backends",nargs="+",default=["numpy","windowed","adaptive"])
+    parser.add_argument("--frame-steps",nargs="+",type=int,default=[20,50,100])
+    parser.add_argument("--time-steps",nargs="+",type=int,default=[100,300])
+    parser.add_argument("--regimes",nargs="+",default=list(REGIMES),choices=list(REGIMES))
+    parser.add_argument("--reference-frame-steps",type=int,default=400)
+    parser.add_argument("--repeats",type=int,default=3)
+    arguments=parser.parse_args(arguments)
+    rows=run_benchmark(arguments.methods,arguments.backends,arguments.frame_steps,arguments.time_steps,{regime:REGIMES[regime] for regime in arguments.regimes},arguments.reference_frame_steps,arguments.repeats)
+    write_results(rows,arguments.output)
+    for row in rows:
+        print("%(method)-6s %(backend)-9s %(regime)-11s frame_steps=%(frame_steps)-4d len(t)=%(time_steps)-5d %(seconds)9.4fs max_error=%(max_error).2e"%row)
+    if arguments.compare:
+        regressions=compare_results(read_results(arguments.compare),rows)
+        for key,field,old,new in regressions:
+            print("REGRESSION %s %s: %g -> %g"%(" ".join(str(part) for part in key),field,old,new))
+        return 1 if regressions else 0
+    return 0
+
+if __name__=="__main__":
+    raise SystemExit(main())
@@ -0,0 +1,82 @@
+import json
+import os
+import numpy as np
+from JAC_Tools.cde_models import CDE_Modelling
+
+def build_lightcurve_grid(path,prr_values,dtr_values,dc_values,ipr_values,positions,kind="slice",frame_steps=30,ldca=0.3,ldcb=0.1,ii=160.0,n_workers=None):
+    """
+        Sweep CDE_Modelling over a grid of morphology parameters and store the lightcurves in the directory path.
+
+        The lightcurves are calculated at the planet horizontal positions in positions (in stellar radii from the centre of the star),
+        which is the same as a lightcurve in time with t0=0 and an orbital speed of 1, so a single grid can be used for any t0, sma
+        and per. The positions should reach out of transit on both sides as each lightcurve is normalised by its own maximum.
+
+        The store is made of lightcurves.npy, an array of shape (len(prr_values),len(dtr_values),len(dc_values),len(ipr_values),len(positions))
+        written as a memory map, and metadata.json which holds the axes and the fixed parameters. metadata.json is written last,
+        so a store which was interrupted part way through cannot be opened by LightcurveGrid.
+    """
+    axes=[np.unique(np.asarray(values,dtype=float)) for values in (prr_values,dtr_values,dc_values,ipr_values)]
+    positions=np.asarray(positions,dtype=float)
+    if np.any(np.diff(positions)<=0):
+        raise ValueError("positions must be strictly increasing.")
+    os.makedirs(path,exist_ok=True)
+    shape=tuple(len(axis) for axis in axes)+(len(positions),)
+    lightcurves=np.lib.format.open_memmap(os.path.join(path,"lightcurves.npy"),mode="w+",dtype=np.float64,shape=shape)
+    model=CDE_Modelling(ldca=ldca,ldcb=ldcb,ii=ii)
+    dtr_grid,dc_grid,ipr_grid=[grid.ravel() for grid in np.meshgrid(*axes[1:],indexing="ij")]
+    for i,prr in enumerate(axes[0]):
+        params=np.column_stack([np.full(len(dtr_grid),prr),dtr_grid,dc_grid,ipr_grid,np.full(len(dtr_grid),ldca),np.full(len(dtr_grid),ldcb),np.zeros(len(dtr_grid)),np.ones(len(dtr_grid)),np.full(len(dtr_grid),2*np.pi)])
+        lightcurves[i]=model.batch_lightcurve(positions,params,kind,frame_steps,n_workers).reshape(shape[1:])
+    lightcurves.flush()
+    del lightcurves
+    metadata={"prr":axes[0].tolist(),"dtr":axes[1].tolist(),"dc":axes[2].tolist(),"ipr":axes[3].tolist(),"positions":positions.tolist(),"kind":kind,"frame_steps":frame_steps,"ldca":ldca,"ldcb":ldcb,"ii":ii}
+    with open(os.path.join(path,"metadata.json"),"w") as metadata_file:
+        json.dump(metadata,metadata_file)
+    return LightcurveGrid(path)
+
+class LightcurveGrid:
+    """
+        Fast lookup of CDE lightcurves from a grid written by build_lightcurve_grid.
+
+        The lightcurves are opened read only as a memory map, so many processes can share the same store without loading it into memory,
+        only the (at most 16) lightcurves around the requested parameters are read for each call.
+    """
+    def __init__(self,path):
+        """
+            Open the grid stored in the directory path.
+        """
+        with open(os.path.join(path,"metadata.json")) as metadata_file:
+            self.metadata=json.load(metadata_file)
+        self.axes=[np.array(self.metadata[name]) for name in ("prr","dtr","dc","ipr")]
+        self.positions=np.array(self.metadata["positions"])
+        self.lightcurves=np.load(os.path.join(path,"lightcurves.npy"),mmap_mode="r")
+    def axis_weights(self,axis,value,name):
+        """
+            Indices and weights of the grid points either side of value for linear interpolation along one axis.
+        """
+        if not axis[0]<=value<=axis[-1]:
+            raise ValueError("%s=%g is outside of the grid (%g to %g)."%(name,value,axis[0],axis[-1]))
+        if len(axis)==1:
+            return [0],[1.0]
+        upper=min(max(int(np.searchsorted(axis,value,"right")),1),len(axis)-1)
+        fraction=(value-axis[upper-1])/(axis[upper]-axis[upper-1])
+        return [upper-1,upper],[1-fraction,fraction]
+    def lightcurve(self,prr,dtr,dc,ipr):
+        """
+            Lightcurve at the stored positions, interpolated linearly between the grid points in each of the four parameters.
+        """
+        (prr_index,prr_weights),(dtr_index,dtr_weights),(dc_index,dc_weights),(ipr_index,ipr_weights)=[self.axis_weights(axis,value,name) for axis,value,name in zip(self.axes,(prr,dtr,dc,ipr),("prr","dtr","dc","ipr"))]
+        cde_lightcurve=np.zeros(len(self.positions))
+        for i,prr_weight in zip(prr_index,prr_weights):
+            for j,dtr_weight in zip(dtr_index,dtr_weights):
+                for k,dc_weight in zip(dc_index,dc_weights):
+                    for l,ipr_weight in zip(ipr_index,ipr_weights):
+                        cde_lightcurve+=prr_weight*dtr_weight*dc_weight*ipr_weight*self.lightcurves[i,j,k,l]
+        return cde_lightcurve
+    def __call__(self,t,prr,dtr,dc,ipr,t0=0.0,sma=15,per=0.85):
+        """
+            Lightcurve at the times t for the given parameters, the times are converted to planet positions with t0, sma and per in the
+            same way as CDE_Modelling. Times beyond the stored positions take the value at the nearest end of the grid.
+        """
+        current_planet_horizontal_positions=(np.asarray(t,dtype=float)-t0)*2*np.pi*sma/per
+        return np.interp(current_planet_horizontal_positions,self.positions,self.lightcurve(prr,dtr,dc,ipr))
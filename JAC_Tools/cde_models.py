@@ -1,4 +1,52 @@
+import time
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager,nullcontext
+from itertools import repeat
+
+_worker_model=None
+def _initialise_worker(model):
+    """
+        Store the model once in each worker process of the pool.
+    """
+    global _worker_model
+    _worker_model=model
+def _worker_frame_intensities(t,kind,frame_steps,backend):
+    return _worker_model.frame_intensities(t,kind,frame_steps,backend)
+def _worker_batch_lightcurve(t,params,kind,frame_steps):
+    return _worker_model.batch_lightcurve(t,params,kind,frame_steps)
+
+_no_timer=nullcontext()
+
+class ModelStatistics:
+    """
+        Timers and counters for the hot paths of CDE_Modelling, collected while CDE_Modelling.profile() is active.
+        
+        timers holds the seconds spent on the stellar image ("stellar"), the star behind the core and tail ("star"), the core term
+        ("core") and the tail term ("tail"). counters holds the number of pixels evaluated, the pixels occulted by the core and by the
+        tail, the frames skipped as out of transit or outside of the stellar disc and the NaN fallbacks hit in I_core_FUNC and I_tail_FUNC
+        (or their array forms), each counted once per pixel. The loop and numpy backends give the same counts, the windowed backend only
+        counts the pixels inside each occulted window and frames are only skipped by the windowed backend and by supersampling.
+        Work done in worker processes (n_workers>1) is not collected.
+    """
+    def __init__(self):
+        self.timers={"stellar":0.0,"star":0.0,"core":0.0,"tail":0.0}
+        self.counters={"pixels_evaluated":0,"pixels_core":0,"pixels_tail":0,"frames_skipped":0,"core_nan":0,"tail_nan":0}
+    @contextmanager
+    def timer(self,name):
+        """
+            Add the time spent inside the with block to timers[name].
+        """
+        start=time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name]+=time.perf_counter()-start
+    def count(self,name,number=1):
+        self.counters[name]+=int(number)
+    def __repr__(self):
+        return "ModelStatistics(timers=%r,counters=%r)"%(self.timers,self.counters)
 
 class CDE_Modelling:
     """
@@ -11,9 +59,20 @@ class CDE_Modelling:
         I recommend using the slice_lightcurve function, this is a good comprimise between the fastest model (which is the intensity of a single pixel)
         vs the slowest model which calculates the combined intensity from the star. This method can also give good estimates of the planetary radius 
         ratio when using a low resolution model, the resolution is set by the radius of the star and of the dust tail, so a radius < 40 pixels is 
-        recommended.        
+        recommended.
+
+        All three lightcurves are calculated with whole array operations by default, backend="windowed" only calculates the
+        pixels under the core and dust tail, backend="adaptive" refines the resolution around the core, tail and limb to reach
+        adaptive_tolerance and backend="loop" gives the original pixel by pixel calculation.
     
     """
+    max_chunk_pixels=2**21#largest number of pixel intensities held in memory at once by the array backend
+    stellar_map_cache_size=8#number of stellar images kept by stellar_map
+    tasks_per_worker=4#number of pieces of work given to each process when n_workers is set
+    adaptive_tolerance=1e-3#largest error in the intensity of a cell of the adaptive backend, relative to the centre of the unocculted star
+    adaptive_max_depth=7#largest number of times a cell of the adaptive backend is halved
+    adaptive_base_steps=8#number of cells across the stellar diameter the adaptive backend starts from
+    jacobian_parameters=("prr","dtr","dc","ipr","ldca","ldcb","t0")#columns of the jacobian from lightcurve_jacobian
     def __init__(self,prr=0.1,dtr=45,dc=-45,ipr=0.0,ii=160.0,ldca=0.3,ldcb=0.1,t0=0.0,sma=15,per=0.85):
         """
             Initialize the parameters of the class, mostly just stellar parameters. 
@@ -36,6 +95,34 @@ class CDE_Modelling:
         self.star_vertical_position=0.0
         self.planet_vertical_position=self.star_vertical_position+self.impact_parameter
         self.orbital_speed=2*np.pi*self.semi_major/self.period
+        self.stellar_map_cache=OrderedDict()
+        self.statistics=None
+    def profile(self,statistics=None):
+        """
+            Context manager which collects a ModelStatistics while it is active, e.g.
+            
+                with CDEM.profile() as stats:
+                    CDEM.full_lightcurve(t)
+                print(stats.timers,stats.counters)
+            
+            When it is not active only a check that statistics is None is made for each block of work.
+        """
+        return self.profiling(ModelStatistics() if statistics is None else statistics)
+    @contextmanager
+    def profiling(self,statistics):
+        previous_statistics=self.statistics
+        self.statistics=statistics
+        try:
+            yield statistics
+        finally:
+            self.statistics=previous_statistics
+    def timer(self,name):
+        """
+            Timer for one of the components in ModelStatistics, which does nothing when profile() is not active.
+        """
+        if self.statistics is None:
+            return _no_timer
+        return self.statistics.timer(name)
     def update_parameters(self):
         """
             If any parameters have been updated then please run this to update the other dependancies.
@@ -99,6 +186,8 @@ class CDE_Modelling:
         I=trans_coeff*np.log(distance_from_planetary_centre+1)
         if np.isnan(I):
             I=0.0
+            if self.statistics is not None:
+                self.statistics.count("core_nan")
         return I
     def I_tail_FUNC(self,stellar_pixel_intensity,current_planet_horizontal_position,tail_lower_bound,pixel_position_hor,pixel_position_ver):
         """
@@ -115,70 +204,730 @@ class CDE_Modelling:
         I=stellar_pixel_intensity*I_combine
         if np.isnan(I):
             I=0.0
+            if self.statistics is not None:
+                self.statistics.count("tail_nan")
         return I
+    def I_star_array(self,distance_ratio_from_stellar_centre):
+        """
+            Array form of I_star_prior*I_star_FUNC, evaluated for a whole grid of distances from the centre of the stellar disc.
+        """
+        mu_in=np.sqrt(np.clip(1-distance_ratio_from_stellar_centre**2,0.0,None))
+        I_ratio=1-self.limb_darkening_coeff_a*(1-mu_in)-self.limb_darkening_coeff_b*(1-mu_in)**2
+        return np.where(distance_ratio_from_stellar_centre<1,self.initial_intensity*I_ratio,0.0)
+    def pixel_intensity_array(self,stellar_pixel_intensity,current_planet_horizontal_position,pixel_position_hor,pixel_position_ver):
+        """
+            Array form of the pixel intensity summed in the lightcurve loops.
+            
+            All of the arguments are broadcast against each other, so the planet positions and the pixel grid can be given as
+            arrays of compatible shape. This gives the same result as the combination of I_star_antiprior, I_core_prior,
+            I_core_FUNC and I_tail_FUNC for every pixel, but the tail term is only calculated once.
+        """
+        tail_lower_bound=self.star_vertical_position-self.planetary_radius
+        tail_upper_bound=self.star_vertical_position+self.planetary_radius
+        with self.timer("star"):
+            #I_star_antiprior
+            r_pl_temp=np.sqrt((self.planet_vertical_position-pixel_position_hor)**2+(current_planet_horizontal_position-pixel_position_ver)**2)
+            tail_mask=(current_planet_horizontal_position>pixel_position_hor)&(pixel_position_hor>=current_planet_horizontal_position-self.dust_tail_length)&(tail_lower_bound<pixel_position_ver)&(pixel_position_ver<tail_upper_bound)
+            core_mask=(r_pl_temp<self.planetary_radius)&(current_planet_horizontal_position<=pixel_position_hor)&(pixel_position_hor<=current_planet_horizontal_position+self.planetary_radius)
+            star_antiprior=np.where(tail_mask|core_mask,0.0,1.0)
+        with self.timer("core"):
+            #I_core_prior and I_core_FUNC
+            r_pl_temp=np.sqrt((self.planet_vertical_position-pixel_position_ver)**2+(current_planet_horizontal_position-pixel_position_hor)**2)
+            core_prior=np.where((r_pl_temp<self.planetary_radius)&(current_planet_horizontal_position<=pixel_position_ver)&(pixel_position_ver<=current_planet_horizontal_position+self.planetary_radius),1.0,0.0)
+            distance_from_planetary_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(current_planet_horizontal_position-pixel_position_hor)**2)
+            I_core=stellar_pixel_intensity/(np.log(self.planetary_radius+1))*np.log(distance_from_planetary_centre+1)
+            core_nan=np.isnan(I_core)
+            I_core=np.where(core_nan,0.0,I_core)
+        with self.timer("tail"):
+            #I_tail_FUNC
+            distance_from_tail_centre=np.abs(self.planet_vertical_position-pixel_position_ver)
+            max_distance_from_tail_centre=np.abs(self.planet_vertical_position-tail_lower_bound)
+            I_tail=(np.exp(-pixel_position_hor/self.decay_constant)-np.exp(-current_planet_horizontal_position/self.decay_constant))/(np.exp(-(current_planet_horizontal_position-self.dust_tail_length)/self.decay_constant)-np.exp(-(current_planet_horizontal_position/self.decay_constant)))
+            I_vert=1/(np.log(max_distance_from_tail_centre+1))*np.log(distance_from_tail_centre+1)
+            I_combine=np.sqrt((I_vert)**2+I_tail**2)
+            I_combine=np.where(I_combine>1.0,1.0,I_combine)
+            I_tail=stellar_pixel_intensity*I_combine
+            tail_nan=np.isnan(I_tail)
+            I_tail=np.where(tail_nan,0.0,I_tail)
+        pixel_intensity=stellar_pixel_intensity*star_antiprior+core_prior*I_core+I_tail*I_tail
+        if self.statistics is not None:
+            self.statistics.count("pixels_evaluated",pixel_intensity.size)
+            self.statistics.count("pixels_core",np.count_nonzero(np.broadcast_to(core_mask|(core_prior>0),pixel_intensity.shape)))
+            self.statistics.count("pixels_tail",np.count_nonzero(np.broadcast_to(tail_mask,pixel_intensity.shape)))
+            self.statistics.count("core_nan",np.count_nonzero(np.broadcast_to(core_nan,pixel_intensity.shape)))
+            self.statistics.count("tail_nan",np.count_nonzero(np.broadcast_to(tail_nan,pixel_intensity.shape)))
+        return pixel_intensity
+    def pixel_grid(self,kind,frame_steps):
+        """
+            Pixel positions used by each of the lightcurve models.
+            
+            kind is one of "quick" (the single pixel at the centre of the star), "slice" (a horizontal slice across the centre of the star)
+            or "full" (the entire frame). The horizontal positions are returned as a column and the vertical positions as a row so they
+            broadcast to the full grid.
+        """
+        if kind=="quick":
+            pixel_position_hor_range=np.array([self.star_horizontal_position])
+            pixel_position_ver_range=np.array([self.star_vertical_position])
+        elif kind=="slice":
+            pixel_position_hor_range=np.linspace(self.star_horizontal_position-1,self.star_horizontal_position+1,frame_steps)
+            pixel_position_ver_range=np.array([self.star_vertical_position])
+        elif kind=="full":
+            pixel_position_hor_range=np.linspace(self.star_horizontal_position-1,self.star_horizontal_position+1,frame_steps)
+            pixel_position_ver_range=np.linspace(self.star_vertical_position-1,self.star_vertical_position+1,frame_steps)
+        else:
+            raise ValueError("Unknown lightcurve kind '%s', use 'quick', 'slice' or 'full'."%kind)
+        return pixel_position_hor_range[:,None],pixel_position_ver_range[None,:]
+    def stellar_map(self,kind,frame_steps):
+        """
+            Limb darkened image of the star on the pixel grid of a lightcurve model, the total flux of that image and the intensity
+            of the frame when nothing is in front of the star (which includes the squared tail term of every pixel).
+            
+            The images are kept in a small least recently used cache keyed on the grid and on limb_darkening_coeff_a/b and
+            initial_intensity, so changing any of these gives a new image without needing update_parameters(). Fits which only
+            vary the planet and tail parameters reuse the same image.
+        """
+        key=(kind,frame_steps,self.star_horizontal_position,self.star_vertical_position,self.limb_darkening_coeff_a,self.limb_darkening_coeff_b,self.initial_intensity)
+        if key in self.stellar_map_cache:
+            self.stellar_map_cache.move_to_end(key)
+            return self.stellar_map_cache[key]
+        with self.timer("stellar"):
+            pixel_position_hor_range,pixel_position_ver_range=self.pixel_grid(kind,frame_steps)
+            distance_ratio_from_stellar_centre=np.sqrt((self.star_vertical_position-pixel_position_ver_range)**2+(self.star_horizontal_position-pixel_position_hor_range)**2)
+            stellar_pixel_intensity=self.I_star_array(distance_ratio_from_stellar_centre)
+            stellar_pixel_intensity.setflags(write=False)
+            self.stellar_map_cache[key]=(stellar_pixel_intensity,stellar_pixel_intensity.sum(),(stellar_pixel_intensity+stellar_pixel_intensity**2).sum())
+        while len(self.stellar_map_cache)>self.stellar_map_cache_size:
+            self.stellar_map_cache.popitem(last=False)
+        return self.stellar_map_cache[key]
+    def frame_intensities_loop(self,current_planet_horizontal_positions,kind,frame_steps):
+        """
+            Summed intensity of the frame at each planet position, calculated one pixel at a time.
+            
+            This is the original scheme and is kept as a reference for the array backend, it is very slow for large frames.
+        """
+        pixel_position_hor_range,pixel_position_ver_range=self.pixel_grid(kind,frame_steps)
+        cde_lightcurve=[]
+        for current_planet_horizontal_position in current_planet_horizontal_positions:
+            frame_intensity=0
+            for pixel_position_hor in pixel_position_hor_range[:,0]:
+                for pixel_position_ver in pixel_position_ver_range[0,:]:
+                    distance_from_planetary_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(current_planet_horizontal_position-pixel_position_hor)**2)
+                    distance_ratio_from_stellar_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(self.star_horizontal_position-pixel_position_hor)**2)
+                    tail_lower_bound=self.star_vertical_position-self.planetary_radius
+                    tail_upper_bound=self.star_vertical_position+self.planetary_radius
+                    stellar_pixel_intensity=self.I_star_prior(distance_ratio_from_stellar_centre)*self.I_star_FUNC(distance_ratio_from_stellar_centre)
+                    core_prior=self.I_core_prior(current_planet_horizontal_position,pixel_position_hor,pixel_position_ver)
+                    tail_intensity=self.I_tail_FUNC(stellar_pixel_intensity,current_planet_horizontal_position,tail_lower_bound,pixel_position_hor,pixel_position_ver)
+                    pixel_intensity=stellar_pixel_intensity*self.I_star_antiprior(current_planet_horizontal_position,pixel_position_hor,pixel_position_ver,tail_lower_bound,tail_upper_bound)+core_prior*self.I_core_FUNC(stellar_pixel_intensity,distance_from_planetary_centre)+tail_intensity*tail_intensity
+                    frame_intensity+=pixel_intensity
+                    if self.statistics is not None:
+                        #with empty tail bounds I_star_antiprior is only 0 inside its core, the same pixels as the array backends count
+                        if core_prior>0 or self.I_star_antiprior(current_planet_horizontal_position,pixel_position_hor,pixel_position_ver,tail_lower_bound,tail_lower_bound)==0:
+                            self.statistics.count("pixels_core")
+                        if self.I_tail_prior(current_planet_horizontal_position,tail_lower_bound,tail_upper_bound,pixel_position_ver,pixel_position_hor)>0:
+                            self.statistics.count("pixels_tail")
+            cde_lightcurve.append(frame_intensity)
+            if self.statistics is not None:
+                self.statistics.count("pixels_evaluated",pixel_position_hor_range.size*pixel_position_ver_range.size)
+        return np.array(cde_lightcurve,dtype=float)
+    def frame_intensities_numpy(self,current_planet_horizontal_positions,kind,frame_steps):
+        """
+            Summed intensity of the frame at each planet position, calculated as whole arrays.
+            
+            The pixel grid is evaluated against blocks of planet positions at once, the size of each block is set so that no more than
+            max_chunk_pixels intensities are held in memory.
+        """
+        pixel_position_hor_range,pixel_position_ver_range=self.pixel_grid(kind,frame_steps)
+        stellar_pixel_intensity=self.stellar_map(kind,frame_steps)[0]
+        current_planet_horizontal_positions=np.asarray(current_planet_horizontal_positions,dtype=float).ravel()
+        chunk=max(1,self.max_chunk_pixels//stellar_pixel_intensity.size)
+        cde_lightcurve=np.empty(len(current_planet_horizontal_positions))
+        with np.errstate(divide="ignore",invalid="ignore",over="ignore"):
+            for start in range(0,len(current_planet_horizontal_positions),chunk):
+                current_planet_horizontal_position=current_planet_horizontal_positions[start:start+chunk,None,None]
+                pixel_intensity=self.pixel_intensity_array(stellar_pixel_intensity,current_planet_horizontal_position,pixel_position_hor_range,pixel_position_ver_range)
+                cde_lightcurve[start:start+chunk]=pixel_intensity.sum(axis=(1,2))
+        return cde_lightcurve
+    def has_occulted_window(self):
+        """
+            Whether occulted_window is defined for the current parameters, it is not when there is no core, no tail width, no tail
+            length or decay_constant=0 (with no tail length the tail term is 0/0 for a whole column of pixels, not just the window).
+        """
+        return self.planetary_radius>0 and self.dust_tail_length!=0 and self.decay_constant!=0 and self.planet_vertical_position!=self.star_vertical_position-self.planetary_radius
+    def occulted_window(self,current_planet_horizontal_position):
+        """
+            Region of the frame in which the planetary core and dust tail change the pixel intensity, for each planet position.
+            
+            Returns the horizontal and vertical bounds (hor_low,hor_high,ver_low,ver_high). Outside of this box every pixel has the
+            unocculted intensity: the star is not hidden, the core prior is zero and the combined tail intensity is clipped to 1.
+            The horizontal extent covers the tail (from current_planet_horizontal_position-dust_tail_length to the point where
+            the tail profile reaches -1 on the other side of the core) and the core, the vertical extent covers tail_lower_bound
+            to tail_upper_bound and the core.
+        """
+        current_planet_horizontal_position=np.asarray(current_planet_horizontal_position,dtype=float)
+        tail_lower_bound=self.star_vertical_position-self.planetary_radius
+        tail_upper_bound=self.star_vertical_position+self.planetary_radius
+        max_distance_from_tail_centre=abs(self.planet_vertical_position-tail_lower_bound)
+        with np.errstate(divide="ignore",invalid="ignore",over="ignore"):
+            tail_profile_ratio=2-np.exp(self.dust_tail_length/self.decay_constant)
+            tail_far_end=current_planet_horizontal_position-self.decay_constant*np.log(tail_profile_ratio)
+        if not tail_profile_ratio>0:
+            tail_far_end=current_planet_horizontal_position+np.copysign(np.inf,self.dust_tail_length)
+        tail_start=current_planet_horizontal_position-self.dust_tail_length
+        hor_low=np.minimum(np.minimum(tail_start,tail_far_end),current_planet_horizontal_position-self.planetary_radius)
+        hor_high=np.maximum(np.maximum(tail_start,tail_far_end),current_planet_horizontal_position+self.planetary_radius)
+        ver_low=min(tail_lower_bound,self.planet_vertical_position-max_distance_from_tail_centre,self.planet_vertical_position-self.planetary_radius)
+        ver_high=max(tail_upper_bound,self.planet_vertical_position+max_distance_from_tail_centre,self.planet_vertical_position+self.planetary_radius)
+        #I_star_antiprior also hides the star in a disc centred on (planet_vertical_position,current_planet_horizontal_position)
+        antiprior_core=(current_planet_horizontal_position<self.planet_vertical_position+self.planetary_radius)&(current_planet_horizontal_position+self.planetary_radius>self.planet_vertical_position-self.planetary_radius)
+        ver_low=np.where(antiprior_core,np.minimum(ver_low,current_planet_horizontal_position-self.planetary_radius),ver_low)
+        ver_high=np.where(antiprior_core,np.maximum(ver_high,current_planet_horizontal_position+self.planetary_radius),ver_high)
+        #far from the star the exponentials in I_tail_FUNC overflow and every pixel is changed
+        overflow=(np.abs(current_planet_horizontal_position)+abs(self.dust_tail_length)+2)/abs(self.decay_constant)>700
+        hor_low=np.where(overflow,-np.inf,hor_low)
+        hor_high=np.where(overflow,np.inf,hor_high)
+        ver_low=np.where(overflow,-np.inf,ver_low)
+        ver_high=np.where(overflow,np.inf,ver_high)
+        return hor_low,hor_high,ver_low,ver_high
+    def frame_intensities_windowed(self,current_planet_horizontal_positions,kind,frame_steps):
+        """
+            Summed intensity of the frame at each planet position, only calculating the pixels under the core and dust tail.
+            
+            The pixels inside occulted_window are evaluated and their change from the unocculted intensity is subtracted from the
+            cached unocculted frame, frames where the window misses the stellar disc are not evaluated at all. The runtime scales
+            with the occulted area rather than the frame area. Parameter sets for which the window is not defined (no core,
+            no tail width, no tail length or decay_constant=0) fall back to the numpy backend.
+        """
+        if not self.has_occulted_window():
+            return self.frame_intensities_numpy(current_planet_horizontal_positions,kind,frame_steps)
+        pixel_position_hor_range,pixel_position_ver_range=self.pixel_grid(kind,frame_steps)
+        stellar_pixel_intensity,stellar_flux,unocculted_intensity=self.stellar_map(kind,frame_steps)
+        current_planet_horizontal_positions=np.asarray(current_planet_horizontal_positions,dtype=float).ravel()
+        hor_low,hor_high,ver_low,ver_high=self.occulted_window(current_planet_horizontal_positions)
+        #the stellar disc only covers -1 to 1, which is already the edge of the pixel grid
+        hor_start=np.clip(np.searchsorted(pixel_position_hor_range[:,0],hor_low,"left")-1,0,None)
+        hor_stop=np.searchsorted(pixel_position_hor_range[:,0],hor_high,"right")+1
+        ver_start=np.clip(np.searchsorted(pixel_position_ver_range[0,:],ver_low,"left")-1,0,None)
+        ver_stop=np.searchsorted(pixel_position_ver_range[0,:],ver_high,"right")+1
+        cde_lightcurve=np.full(len(current_planet_horizontal_positions),unocculted_intensity)
+        #the padding above would give frames whose window misses the grid a one pixel window, so these are found from the unpadded window
+        in_window=np.nonzero(~self.out_of_transit(current_planet_horizontal_positions,kind,frame_steps))[0]
+        if self.statistics is not None:
+            self.statistics.count("frames_skipped",len(current_planet_horizontal_positions)-len(in_window))
+        with np.errstate(divide="ignore",invalid="ignore",over="ignore"):
+            for i in in_window:
+                window=(slice(hor_start[i],hor_stop[i]),slice(ver_start[i],ver_stop[i]))
+                window_stellar_pixel_intensity=stellar_pixel_intensity[window]
+                pixel_intensity=self.pixel_intensity_array(window_stellar_pixel_intensity,current_planet_horizontal_positions[i],pixel_position_hor_range[window[0]],pixel_position_ver_range[:,window[1]])
+                cde_lightcurve[i]+=(pixel_intensity-window_stellar_pixel_intensity-window_stellar_pixel_intensity**2).sum()
+        return cde_lightcurve
+    def adaptive_integral(self,field,hor_low,hor_high,ver_low,ver_high):
+        """
+            Integral of field(pixel_position_hor,pixel_position_ver) over a box, on a grid which is only refined where it is needed.
+            
+            The box starts as cells 2/adaptive_base_steps stellar radii across. A cell is split into four while the field at its
+            centre differs from the mean of its corners by more than adaptive_tolerance*(initial_intensity+initial_intensity**2),
+            which picks out the edges of the core, tail and stellar limb as well as strongly curved intensity, or while it is wider
+            than half the planetary radius. Cells are not split once they have been halved adaptive_max_depth times. The integral
+            is the sum of the field at the centre of every final cell times its area. If ver_low==ver_high the integral is along
+            the horizontal line at that height instead.
+        """
+        line=ver_low==ver_high
+        reference=self.initial_intensity+self.initial_intensity**2
+        smallest_half_width=1.0/(self.adaptive_base_steps*2**self.adaptive_max_depth)
+        hor_steps=max(1,int(np.ceil((hor_high-hor_low)*self.adaptive_base_steps/2)))
+        half_width_hor=(hor_high-hor_low)/(2*hor_steps)
+        pixel_position_hor=hor_low+half_width_hor*(2*np.arange(hor_steps)+1)
+        if line:
+            half_width_ver=0.0
+            pixel_position_ver=np.full(hor_steps,float(ver_low))
+        else:
+            ver_steps=max(1,int(np.ceil((ver_high-ver_low)*self.adaptive_base_steps/2)))
+            half_width_ver=(ver_high-ver_low)/(2*ver_steps)
+            pixel_position_hor,pixel_position_ver=np.meshgrid(pixel_position_hor,ver_low+half_width_ver*(2*np.arange(ver_steps)+1),indexing="ij")
+            pixel_position_hor,pixel_position_ver=pixel_position_hor.ravel(),pixel_position_ver.ravel()
+        integral=0.0
+        while len(pixel_position_hor):
+            cell_area=2*half_width_hor if line else 4*half_width_hor*half_width_ver
+            centre=field(pixel_position_hor,pixel_position_ver)
+            if max(half_width_hor,half_width_ver)<=smallest_half_width:
+                integral+=centre.sum()*cell_area
+                break
+            if line:
+                corners=[field(pixel_position_hor+i*half_width_hor,pixel_position_ver) for i in (-1,1)]
+            else:
+                corners=[field(pixel_position_hor+i*half_width_hor,pixel_position_ver+j*half_width_ver) for i in (-1,1) for j in (-1,1)]
+            refine=np.abs(centre-np.mean(corners,axis=0))>self.adaptive_tolerance*reference
+            if max(half_width_hor,half_width_ver)>self.planetary_radius/2:
+                refine[:]=True
+            integral+=centre[~refine].sum()*cell_area
+            pixel_position_hor,pixel_position_ver=pixel_position_hor[refine],pixel_position_ver[refine]
+            half_width_hor/=2
+            half_width_ver/=2
+            if line:
+                pixel_position_hor=np.concatenate([pixel_position_hor-half_width_hor,pixel_position_hor+half_width_hor])
+                pixel_position_ver=np.concatenate([pixel_position_ver,pixel_position_ver])
+            else:
+                pixel_position_hor=np.concatenate([pixel_position_hor-half_width_hor,pixel_position_hor+half_width_hor,pixel_position_hor-half_width_hor,pixel_position_hor+half_width_hor])
+                pixel_position_ver=np.concatenate([pixel_position_ver-half_width_ver,pixel_position_ver-half_width_ver,pixel_position_ver+half_width_ver,pixel_position_ver+half_width_ver])
+        return integral
+    def unocculted_field(self,pixel_position_hor,pixel_position_ver):
+        """
+            Intensity of each pixel when nothing is in front of the star, including the squared tail term.
+        """
+        stellar_pixel_intensity=self.I_star_array(np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(self.star_horizontal_position-pixel_position_hor)**2))
+        return stellar_pixel_intensity+stellar_pixel_intensity**2
+    def unocculted_intensity(self,kind,frame_steps,backend="numpy"):
+        """
+            Summed intensity of the frame when nothing is in front of the star, on the same scale as the given backend.
+            
+            For the adaptive backend this is the adaptive integral over the stellar disc, which is cached alongside the stellar images.
+        """
+        if backend!="adaptive" or kind=="quick" or not self.has_occulted_window():
+            return self.stellar_map(kind,frame_steps)[2]
+        key=("adaptive",kind,self.star_horizontal_position,self.star_vertical_position,self.limb_darkening_coeff_a,self.limb_darkening_coeff_b,self.initial_intensity,self.adaptive_tolerance,self.adaptive_max_depth,self.adaptive_base_steps)
+        if key in self.stellar_map_cache:
+            self.stellar_map_cache.move_to_end(key)
+            return self.stellar_map_cache[key]
+        ver_half_width=0.0 if kind=="slice" else 1.0
+        with self.timer("stellar"):
+            self.stellar_map_cache[key]=self.adaptive_integral(self.unocculted_field,self.star_horizontal_position-1,self.star_horizontal_position+1,self.star_vertical_position-ver_half_width,self.star_vertical_position+ver_half_width)
+        while len(self.stellar_map_cache)>self.stellar_map_cache_size:
+            self.stellar_map_cache.popitem(last=False)
+        return self.stellar_map_cache[key]
+    def frame_intensities_adaptive(self,current_planet_horizontal_positions,kind,frame_steps):
+        """
+            Integrated intensity of the frame at each planet position, using a grid which is only refined where it is needed.
+            
+            Rather than a fixed frame_steps, the change from the unocculted star is integrated over occulted_window with
+            adaptive_integral, so the resolution follows the core, the tail and the limb where they are in front of the star and the
+            accuracy is set by adaptive_tolerance. The result is an integral over the frame rather than a sum of pixels, so it is
+            only on the same scale as the other backends once the lightcurve is normalised. The quick lightcurve and parameter
+            sets for which the window is not defined use the numpy backend.
+        """
+        if kind=="quick" or not self.has_occulted_window():
+            return self.frame_intensities_numpy(current_planet_horizontal_positions,kind,frame_steps)
+        current_planet_horizontal_positions=np.asarray(current_planet_horizontal_positions,dtype=float).ravel()
+        hor_low,hor_high,ver_low,ver_high=self.occulted_window(current_planet_horizontal_positions)
+        hor_low=np.clip(hor_low,self.star_horizontal_position-1,self.star_horizontal_position+1)
+        hor_high=np.clip(hor_high,self.star_horizontal_position-1,self.star_horizontal_position+1)
+        if kind=="slice":
+            in_transit=(hor_low<hor_high)&(ver_low<=self.star_vertical_position)&(self.star_vertical_position<=ver_high)
+            ver_low=ver_high=np.full(len(current_planet_horizontal_positions),self.star_vertical_position)
+        else:
+            ver_low=np.clip(ver_low,self.star_vertical_position-1,self.star_vertical_position+1)
+            ver_high=np.clip(ver_high,self.star_vertical_position-1,self.star_vertical_position+1)
+            in_transit=(hor_low<hor_high)&(ver_low<ver_high)
+        cde_lightcurve=np.full(len(current_planet_horizontal_positions),self.unocculted_intensity(kind,frame_steps,"adaptive"))
+        if self.statistics is not None:
+            self.statistics.count("frames_skipped",len(in_transit)-np.count_nonzero(in_transit))
+        with np.errstate(divide="ignore",invalid="ignore",over="ignore"):
+            for i in np.nonzero(in_transit)[0]:
+                def occulted_field(pixel_position_hor,pixel_position_ver):
+                    stellar_pixel_intensity=self.I_star_array(np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(self.star_horizontal_position-pixel_position_hor)**2))
+                    return self.pixel_intensity_array(stellar_pixel_intensity,current_planet_horizontal_positions[i],pixel_position_hor,pixel_position_ver)-stellar_pixel_intensity-stellar_pixel_intensity**2
+                cde_lightcurve[i]+=self.adaptive_integral(occulted_field,hor_low[i],hor_high[i],ver_low[i],ver_high[i])
+        return cde_lightcurve
+    def worker_pool(self,n_workers):
+        """
+            Process pool in which every worker holds its own copy of this model, so the parameters are only sent once per worker.
+        """
+        return ProcessPoolExecutor(max_workers=n_workers,initializer=_initialise_worker,initargs=(self,))
+    def out_of_transit(self,current_planet_horizontal_positions,kind,frame_steps):
+        """
+            True for each planet position at which neither the core nor the dust tail changes any pixel of the frame.
+            
+            This uses occulted_window, so when the window is not defined (no core, no tail width, no tail length or decay_constant=0) every
+            position is treated as in transit.
+        """
+        current_planet_horizontal_positions=np.asarray(current_planet_horizontal_positions,dtype=float)
+        if not self.has_occulted_window():
+            return np.zeros(current_planet_horizontal_positions.shape,dtype=bool)
+        pixel_position_hor_range,pixel_position_ver_range=self.pixel_grid(kind,frame_steps)
+        hor_low,hor_high,ver_low,ver_high=self.occulted_window(current_planet_horizontal_positions)
+        return (hor_high<pixel_position_hor_range.min())|(hor_low>pixel_position_hor_range.max())|(ver_high<pixel_position_ver_range.min())|(ver_low>pixel_position_ver_range.max())
+    def supersampled_frame_intensities(self,t,kind,frame_steps,backend,n_workers,exposure_time,supersample):
+        """
+            Summed intensity of the frame averaged over an exposure of length exposure_time centred on each time in t.
+            
+            Each exposure is integrated with the trapezium rule over supersample intervals. The sub-exposure times are shared between
+            neighbouring cadences (for contiguous exposures the end of one is the start of the next) and are only evaluated once,
+            sub-exposures which are out of transit are given the unocculted intensity of the frame without being evaluated.
+        """
+        t=np.asarray(t,dtype=float)
+        sub_exposure_offsets=np.linspace(-0.5,0.5,supersample+1)*exposure_time
+        sub_exposure_weights=np.ones(supersample+1)
+        sub_exposure_weights[[0,-1]]=0.5
+        sub_exposure_weights/=supersample
+        sub_exposure_times=(t.ravel()[:,None]+sub_exposure_offsets[None,:]).ravel()
+        #times closer than a millionth of a sub-exposure are treated as the same sub-exposure
+        sub_exposure_keys=np.round(sub_exposure_times/(abs(exposure_time)/supersample*1e-6))
+        sub_exposure_keys,first_index,inverse=np.unique(sub_exposure_keys,return_index=True,return_inverse=True)
+        unique_times=sub_exposure_times[first_index]
+        unique_intensities=np.full(len(unique_times),self.unocculted_intensity(kind,frame_steps,backend))
+        in_transit=~self.out_of_transit((unique_times-self.epoch_shift)*self.orbital_speed,kind,frame_steps)
+        if self.statistics is not None:
+            self.statistics.count("frames_skipped",len(in_transit)-np.count_nonzero(in_transit))
+        unique_intensities[in_transit]=self.frame_intensities(unique_times[in_transit],kind,frame_steps,backend,n_workers)
+        frame_intensity=unique_intensities[inverse.ravel()].reshape(-1,supersample+1)@sub_exposure_weights
+        return frame_intensity.reshape(t.shape)
+    def frame_intensities(self,t,kind="full",frame_steps=50,backend="numpy",n_workers=None,exposure_time=None,supersample=1):
+        """
+            Summed (un-normalised) intensity of the frame at each time in t.
+            
+            backend="numpy" evaluates the pixel grid as whole arrays, backend="windowed" only evaluates the pixels under the core
+            and dust tail, backend="adaptive" integrates the frame on a grid refined around the core, tail and limb (see
+            frame_intensities_adaptive) and backend="loop" uses the original pixel by pixel loop.
+            
+            If n_workers is more than 1 the times are split into blocks which are shared across a pool of n_workers processes,
+            the results are returned in the original order.
+            
+            If exposure_time is given and supersample is more than 1 the intensity is averaged over each exposure, see
+            supersampled_frame_intensities. exposure_time=0 is the same as no exposure_time.
+        """
+        if isinstance(supersample,bool) or not isinstance(supersample,(int,np.integer)) or supersample<1:
+            raise ValueError("supersample must be a positive integer, not %r."%(supersample,))
+        if exposure_time is not None and exposure_time!=0 and supersample>1:
+            return self.supersampled_frame_intensities(t,kind,frame_steps,backend,n_workers,exposure_time,supersample)
+        if n_workers is not None and n_workers>1:
+            t_blocks=[t_block for t_block in np.array_split(np.asarray(t,dtype=float),n_workers*self.tasks_per_worker) if len(t_block)]
+            with self.worker_pool(n_workers) as executor:
+                return np.concatenate(list(executor.map(_worker_frame_intensities,t_blocks,repeat(kind),repeat(frame_steps),repeat(backend)))+[np.empty(0)])
+        current_planet_horizontal_positions=(np.asarray(t,dtype=float)-self.epoch_shift)*self.orbital_speed
+        if backend=="numpy":
+            return self.frame_intensities_numpy(current_planet_horizontal_positions,kind,frame_steps)
+        elif backend=="windowed":
+            return self.frame_intensities_windowed(current_planet_horizontal_positions,kind,frame_steps)
+        elif backend=="adaptive":
+            return self.frame_intensities_adaptive(current_planet_horizontal_positions,kind,frame_steps)
+        elif backend=="loop":
+            return self.frame_intensities_loop(current_planet_horizontal_positions,kind,frame_steps)
+        raise ValueError("Unknown backend '%s', use 'numpy', 'windowed', 'adaptive' or 'loop'."%backend)
     def uniformLimbDarkening_lightcurve_intensity_correction(self,quick_lightcurve):
         delta_flux=(max(quick_lightcurve)-min(quick_lightcurve))
         
         stellar_intensity=delta_flux/(self.planetary_radius**2)
         return quick_lightcurve+stellar_intensity-delta_flux
-    def quick_lightcurve(self,t):
+    def quick_lightcurve(self,t,backend="numpy",n_workers=None,exposure_time=None,supersample=1):
         """
             Lightcurve of the CDE for a single pixel at the centre of the star. This model gives no real information on the planetary radius.
+            
+            Give exposure_time (in days) and supersample to average the model over each exposure, e.g. exposure_time=0.0204 for
+            Kepler long cadence.
         """
-        quick_cde_lightcurve=[]
-        for current_planet_horizontal_position in (t-self.epoch_shift)*self.orbital_speed:
-            pixel_position_hor=self.star_horizontal_position 
-            pixel_position_ver=self.star_vertical_position
-            distance_from_planetary_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(current_planet_horizontal_position-pixel_position_hor)**2)
-            distance_ratio_from_stellar_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(self.star_horizontal_position-pixel_position_hor)**2)
-            tail_lower_bound=self.star_vertical_position-self.planetary_radius
-            tail_upper_bound=self.star_vertical_position+self.planetary_radius
-            stellar_pixel_intensity=self.I_star_prior(distance_ratio_from_stellar_centre)*self.I_star_FUNC(distance_ratio_from_stellar_centre)
-            pixel_intensity=stellar_pixel_intensity*self.I_star_antiprior(current_planet_horizontal_position,pixel_position_hor,pixel_position_ver,tail_lower_bound,tail_upper_bound)+self.I_core_prior(current_planet_horizontal_position,pixel_position_hor,pixel_position_ver)*self.I_core_FUNC(stellar_pixel_intensity,distance_from_planetary_centre)+self.I_tail_FUNC(stellar_pixel_intensity,current_planet_horizontal_position,tail_lower_bound,pixel_position_hor,pixel_position_ver)*self.I_tail_FUNC(stellar_pixel_intensity,current_planet_horizontal_position,tail_lower_bound,pixel_position_hor,pixel_position_ver)
-            quick_cde_lightcurve.append(pixel_intensity)
+        quick_cde_lightcurve=self.frame_intensities(t,"quick",1,backend,n_workers,exposure_time,supersample)
         quick_cde_lightcurve=self.uniformLimbDarkening_lightcurve_intensity_correction(quick_cde_lightcurve)
         quick_cde_lightcurve=np.array(quick_cde_lightcurve)/max(quick_cde_lightcurve)
         return quick_cde_lightcurve
-    def slice_lightcurve(self,t,frame_steps=30):
+    def slice_lightcurve(self,t,frame_steps=30,backend="numpy",n_workers=None,exposure_time=None,supersample=1):
         """
             Lightcurve of the CDE for a horizontal slice across the centre of the star. This model gives a good approximation of stellar/planetary parameters.
+            
+            Give exposure_time (in days) and supersample to average the model over each exposure.
         """
-        cde_lightcurve=[]
-        pixel_position_hor_range=np.linspace(self.star_horizontal_position-1,self.star_horizontal_position+1,frame_steps)
-        for current_planet_horizontal_position in (t-self.epoch_shift)*self.orbital_speed:
-            frame_intensity=0
-            for pixel_position_hor in pixel_position_hor_range:
-                pixel_position_ver=self.star_vertical_position
-                distance_from_planetary_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(current_planet_horizontal_position-pixel_position_hor)**2)
-                distance_ratio_from_stellar_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(self.star_horizontal_position-pixel_position_hor)**2)
-                tail_lower_bound=self.star_vertical_position-self.planetary_radius
-                tail_upper_bound=self.star_vertical_position+self.planetary_radius
-                stellar_pixel_intensity=self.I_star_prior(distance_ratio_from_stellar_centre)*self.I_star_FUNC(distance_ratio_from_stellar_centre)
-                frame_intensity+=stellar_pixel_intensity*self.I_star_antiprior(current_planet_horizontal_position,pixel_position_hor,pixel_position_ver,tail_lower_bound,tail_upper_bound)+self.I_core_prior(current_planet_horizontal_position,pixel_position_hor,pixel_position_ver)*self.I_core_FUNC(stellar_pixel_intensity,distance_from_planetary_centre)+self.I_tail_FUNC(stellar_pixel_intensity,current_planet_horizontal_position,tail_lower_bound,pixel_position_hor,pixel_position_ver)*self.I_tail_FUNC(stellar_pixel_intensity,current_planet_horizontal_position,tail_lower_bound,pixel_position_hor,pixel_position_ver)
-            cde_lightcurve.append(frame_intensity)
+        cde_lightcurve=self.frame_intensities(t,"slice",frame_steps,backend,n_workers,exposure_time,supersample)
         cde_lightcurve=np.array(cde_lightcurve)/max(cde_lightcurve)
         return cde_lightcurve
-    def full_lightcurve(self,t,frame_steps=50):
+    def full_lightcurve(self,t,frame_steps=50,backend="numpy",n_workers=None,exposure_time=None,supersample=1):
         """
             Lightcurve of the CDE for the entire frame. This model gives a very good approximation of stellar/planetary parameters.
+            
+            Give exposure_time (in days) and supersample to average the model over each exposure.
         """
-        cde_lightcurve=[]
-        pixel_position_hor_range=np.linspace(self.star_horizontal_position-1,self.star_horizontal_position+1,frame_steps)
-        pixel_position_ver_range=np.linspace(self.star_vertical_position-1,self.star_vertical_position+1,frame_steps)
-        for current_planet_horizontal_position in (t-self.epoch_shift)*self.orbital_speed:
-            frame_intensity=0
-            for pixel_position_hor in pixel_position_hor_range:
-                for pixel_position_ver in pixel_position_ver_range:
-                    distance_from_planetary_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(current_planet_horizontal_position-pixel_position_hor)**2)
-                    distance_ratio_from_stellar_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(self.star_horizontal_position-pixel_position_hor)**2)
-                    tail_lower_bound=self.star_vertical_position-self.planetary_radius
-                    tail_upper_bound=self.star_vertical_position+self.planetary_radius
-                    stellar_pixel_intensity=self.I_star_prior(distance_ratio_from_stellar_centre)*self.I_star_FUNC(distance_ratio_from_stellar_centre)
-                    pixel_intensity=stellar_pixel_intensity*self.I_star_antiprior(current_planet_horizontal_position,pixel_position_hor,pixel_position_ver,tail_lower_bound,tail_upper_bound)+self.I_core_prior(current_planet_horizontal_position,pixel_position_hor,pixel_position_ver)*self.I_core_FUNC(stellar_pixel_intensity,distance_from_planetary_centre)+self.I_tail_FUNC(stellar_pixel_intensity,current_planet_horizontal_position,tail_lower_bound,pixel_position_hor,pixel_position_ver)*self.I_tail_FUNC(stellar_pixel_intensity,current_planet_horizontal_position,tail_lower_bound,pixel_position_hor,pixel_position_ver)
-                    frame_intensity+=pixel_intensity
-            cde_lightcurve.append(frame_intensity)
+        cde_lightcurve=self.frame_intensities(t,"full",frame_steps,backend,n_workers,exposure_time,supersample)
         cde_lightcurve=np.array(cde_lightcurve)/max(cde_lightcurve)
         return cde_lightcurve
+    def folded_template(self,kind="slice",frame_steps=30,backend="numpy",phase_steps=2000,n_workers=None,exposure_time=None,supersample=1):
+        """
+            Normalised lightcurve of a single transit on a grid of orbital phases, used by folded_lightcurve_chunks.
+            
+            The in transit phases are found with out_of_transit over one period, the model is only evaluated at phase_steps phases
+            across the transit and every other phase takes the unocculted intensity. Returns (phases,lightcurve,baseline) where
+            phases are in days from the epoch and baseline is the normalised out of transit level.
+        """
+        search_phases=np.linspace(-self.period/2,self.period/2,20*phase_steps)
+        in_transit=np.nonzero(~self.out_of_transit(search_phases*self.orbital_speed,kind,frame_steps))[0]
+        baseline=self.unocculted_intensity(kind,frame_steps,backend)
+        if len(in_transit)==0:
+            return np.array([0.0]),np.array([1.0]),1.0
+        half_exposure=0.0 if exposure_time is None or supersample<=1 else abs(exposure_time)/2
+        phase_low=search_phases[max(in_transit[0]-1,0)]-half_exposure
+        phase_high=search_phases[min(in_transit[-1]+1,len(search_phases)-1)]+half_exposure
+        phases=np.linspace(phase_low,phase_high,phase_steps)
+        cde_lightcurve=np.append(self.frame_intensities(phases+self.epoch_shift,kind,frame_steps,backend,n_workers,exposure_time,supersample),baseline)
+        if kind=="quick":
+            cde_lightcurve=self.uniformLimbDarkening_lightcurve_intensity_correction(cde_lightcurve)
+        cde_lightcurve=cde_lightcurve/max(cde_lightcurve)
+        return phases,cde_lightcurve[:-1],cde_lightcurve[-1]
+    def folded_lightcurve_chunks(self,t,kind="slice",frame_steps=30,backend="numpy",phase_steps=2000,chunk_size=100000,n_workers=None,exposure_time=None,supersample=1):
+        """
+            Generator of the lightcurve for a long, multi-transit time series, one block of chunk_size times at a time.
+            
+            Unlike the other lightcurves the planet returns every period, t is folded on epoch_shift and period and the transit is
+            only modelled once (see folded_template) then interpolated onto each block of t. t can be any array, including a
+            memory map, and only chunk_size times are held in memory at once, so the baseline can be as long as needed.
+        """
+        phases,template,baseline=self.folded_template(kind,frame_steps,backend,phase_steps,n_workers,exposure_time,supersample)
+        for start in range(0,len(t),chunk_size):
+            t_block=np.asarray(t[start:start+chunk_size],dtype=float)
+            folded_phases=np.mod(t_block-self.epoch_shift+self.period/2,self.period)-self.period/2
+            yield np.interp(folded_phases,phases,template,left=baseline,right=baseline)
+    def folded_lightcurve(self,t,kind="slice",frame_steps=30,backend="numpy",phase_steps=2000,chunk_size=100000,n_workers=None,exposure_time=None,supersample=1):
+        """
+            Lightcurve for a long, multi-transit time series as a single array, see folded_lightcurve_chunks.
+        """
+        return np.concatenate(list(self.folded_lightcurve_chunks(t,kind,frame_steps,backend,phase_steps,chunk_size,n_workers,exposure_time,supersample))+[np.empty(0)])
+    def pixel_intensity_jacobian_array(self,stellar_pixel_intensity,stellar_derivatives,current_planet_horizontal_position,pixel_position_hor,pixel_position_ver):
+        """
+            pixel_intensity_array along with its derivatives with respect to (prr,dtr,dc,ipr,ldca,ldcb) and the planet position.
+
+            stellar_derivatives are the derivatives of the stellar image with respect to ldca and ldcb. The edges of the core, tail
+            and stellar disc are treated as fixed (a pixel moving in or out of the core as prr changes is a step, not a slope), and
+            any pixel whose intensity is replaced by 0 because it is not a number has zero derivatives.
+        """
+        x=current_planet_horizontal_position
+        tail_lower_bound=self.star_vertical_position-self.planetary_radius
+        tail_upper_bound=self.star_vertical_position+self.planetary_radius
+        #I_star_antiprior
+        r_pl_temp=np.sqrt((self.planet_vertical_position-pixel_position_hor)**2+(x-pixel_position_ver)**2)
+        tail_mask=(x>pixel_position_hor)&(pixel_position_hor>=x-self.dust_tail_length)&(tail_lower_bound<pixel_position_ver)&(pixel_position_ver<tail_upper_bound)
+        core_mask=(r_pl_temp<self.planetary_radius)&(x<=pixel_position_hor)&(pixel_position_hor<=x+self.planetary_radius)
+        star_antiprior=np.where(tail_mask|core_mask,0.0,1.0)
+        #I_core_prior and I_core_FUNC
+        r_pl_temp=np.sqrt((self.planet_vertical_position-pixel_position_ver)**2+(x-pixel_position_hor)**2)
+        core_prior=np.where((r_pl_temp<self.planetary_radius)&(x<=pixel_position_ver)&(pixel_position_ver<=x+self.planetary_radius),1.0,0.0)
+        distance_from_planetary_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(x-pixel_position_hor)**2)
+        log_core=np.log(self.planetary_radius+1)
+        core_profile=np.log(distance_from_planetary_centre+1)/log_core
+        I_core=stellar_pixel_intensity*core_profile
+        core_valid=core_prior*~np.isnan(I_core)
+        I_core=np.where(core_valid>0,I_core,0.0)
+        dcore_dprr=-I_core/(log_core*(self.planetary_radius+1))
+        dcore_dx=np.where(distance_from_planetary_centre>0,stellar_pixel_intensity/log_core*(x-pixel_position_hor)/(distance_from_planetary_centre*(distance_from_planetary_centre+1)),0.0)
+        #I_tail_FUNC
+        distance_from_tail_centre=self.planet_vertical_position-pixel_position_ver
+        max_distance_from_tail_centre=self.planet_vertical_position-tail_lower_bound
+        log_vert=np.log(np.abs(distance_from_tail_centre)+1)
+        log_max_vert=np.log(np.abs(max_distance_from_tail_centre)+1)
+        I_vert=log_vert/log_max_vert
+        dvert_dmax=-I_vert/log_max_vert*np.sign(max_distance_from_tail_centre)/(np.abs(max_distance_from_tail_centre)+1)
+        dvert_dipr=np.sign(distance_from_tail_centre)/(np.abs(distance_from_tail_centre)+1)/log_max_vert+dvert_dmax
+        exp_pixel=np.exp(-pixel_position_hor/self.decay_constant)
+        exp_planet=np.exp(-x/self.decay_constant)
+        exp_tail_end=np.exp(-(x-self.dust_tail_length)/self.decay_constant)
+        numerator=exp_pixel-exp_planet
+        denominator=exp_tail_end-exp_planet
+        I_tail=numerator/denominator
+        dtail_dx=(exp_planet/self.decay_constant-I_tail*(exp_planet-exp_tail_end)/self.decay_constant)/denominator
+        dtail_dlength=-I_tail*exp_tail_end/self.decay_constant/denominator
+        dtail_ddc=((exp_pixel*pixel_position_hor-exp_planet*x)-I_tail*(exp_tail_end*(x-self.dust_tail_length)-exp_planet*x))/self.decay_constant**2/denominator
+        I_combine=np.sqrt((I_vert)**2+I_tail**2)
+        slope=np.where((I_combine>0)&(I_combine<=1.0),1/I_combine,0.0)
+        I_combine=np.where(I_combine>1.0,1.0,I_combine)
+        T=stellar_pixel_intensity*I_combine
+        tail_valid=~np.isnan(T)
+        T=np.where(tail_valid,T,0.0)
+        #derivative of T*T is 2*T*dT, with dT=S*d(I_combine)+I_combine*dS
+        tail_scale=np.where(tail_valid,2*T*stellar_pixel_intensity*slope,0.0)
+        dtail_squared=[tail_scale*(I_vert*dvert_dmax+I_tail*dtail_dlength*self.dust_tail_ratio),
+                       tail_scale*I_tail*dtail_dlength*self.planetary_radius,
+                       tail_scale*I_tail*dtail_ddc,
+                       tail_scale*I_vert*dvert_dipr]
+        pixel_intensity=stellar_pixel_intensity*star_antiprior+I_core+T*T
+        derivatives=[core_valid*dcore_dprr+dtail_squared[0],dtail_squared[1],dtail_squared[2],dtail_squared[3]]
+        for stellar_derivative in stellar_derivatives:
+            derivatives.append(stellar_derivative*(star_antiprior+core_valid*core_profile+np.where(tail_valid,2*T*I_combine,0.0)))
+        derivatives.append(core_valid*dcore_dx+tail_scale*I_tail*dtail_dx)
+        return pixel_intensity,[np.where(np.isfinite(derivative),derivative,0.0) for derivative in derivatives]
+    def lightcurve_jacobian(self,t,kind="full",frame_steps=50):
+        """
+            Normalised lightcurve of the given kind ("quick", "slice" or "full") and its jacobian, for gradient based fitting.
+
+            Returns (lightcurve,jacobian) where jacobian has shape (len(t),7) and holds the derivatives of the lightcurve with respect to
+            jacobian_parameters (prr,dtr,dc,ipr,ldca,ldcb,t0), calculated analytically in the same pass over the pixel grid as the
+            lightcurve (see pixel_intensity_jacobian_array). The lightcurve is the same as the numpy backend, and the derivatives include
+            the normalisation by the maximum and, for the quick lightcurve, uniformLimbDarkening_lightcurve_intensity_correction.
+        """
+        pixel_position_hor_range,pixel_position_ver_range=self.pixel_grid(kind,1 if kind=="quick" else frame_steps)
+        stellar_pixel_intensity=self.stellar_map(kind,1 if kind=="quick" else frame_steps)[0]
+        distance_ratio_from_stellar_centre=np.sqrt((self.star_vertical_position-pixel_position_ver_range)**2+(self.star_horizontal_position-pixel_position_hor_range)**2)
+        limb=np.where(distance_ratio_from_stellar_centre<1,1-np.sqrt(np.clip(1-distance_ratio_from_stellar_centre**2,0.0,None)),0.0)
+        stellar_derivatives=(-self.initial_intensity*limb,-self.initial_intensity*limb**2)
+        current_planet_horizontal_positions=(np.asarray(t,dtype=float).ravel()-self.epoch_shift)*self.orbital_speed
+        chunk=max(1,self.max_chunk_pixels//(stellar_pixel_intensity.size*(len(self.jacobian_parameters)+1)))
+        frame_intensity=np.empty(len(current_planet_horizontal_positions))
+        frame_jacobian=np.empty((len(current_planet_horizontal_positions),len(self.jacobian_parameters)))
+        with np.errstate(divide="ignore",invalid="ignore",over="ignore"):
+            for start in range(0,len(current_planet_horizontal_positions),chunk):
+                current_planet_horizontal_position=current_planet_horizontal_positions[start:start+chunk,None,None]
+                pixel_intensity,derivatives=self.pixel_intensity_jacobian_array(stellar_pixel_intensity,stellar_derivatives,current_planet_horizontal_position,pixel_position_hor_range,pixel_position_ver_range)
+                frame_intensity[start:start+chunk]=pixel_intensity.sum(axis=(1,2))
+                for i,derivative in enumerate(derivatives):
+                    frame_jacobian[start:start+chunk,i]=derivative.sum(axis=(1,2))
+        #the last column is the derivative with respect to the planet position, which moves at -orbital_speed with t0
+        frame_jacobian[:,-1]*=-self.orbital_speed
+        if kind=="quick":
+            brightest,faintest=np.argmax(frame_intensity),np.argmin(frame_intensity)
+            delta_flux=frame_intensity[brightest]-frame_intensity[faintest]
+            delta_flux_jacobian=frame_jacobian[brightest]-frame_jacobian[faintest]
+            frame_jacobian=frame_jacobian+delta_flux_jacobian*(1/self.planetary_radius**2-1)
+            frame_jacobian[:,0]+=-2*delta_flux/self.planetary_radius**3
+            frame_intensity=self.uniformLimbDarkening_lightcurve_intensity_correction(frame_intensity)
+        brightest=np.argmax(frame_intensity)
+        maximum=frame_intensity[brightest]
+        cde_lightcurve=frame_intensity/maximum
+        jacobian=frame_jacobian/maximum-cde_lightcurve[:,None]*frame_jacobian[brightest]/maximum
+        return cde_lightcurve,jacobian
+    def stellar_flux_within(self,radius):
+        """
+            Flux of the limb darkened star within radius (in stellar radii) of its centre, found analytically.
+        """
+        mu_in=np.sqrt(np.clip(1-np.minimum(radius,1.0)**2,0.0,None))
+        def antiderivative(mu_in):
+            #integral of I_ratio*mu d(mu)
+            return mu_in**2/2-self.limb_darkening_coeff_a*(mu_in**2/2-mu_in**3/3)-self.limb_darkening_coeff_b*(mu_in**2/2-2*mu_in**3/3+mu_in**4/4)
+        return 2*np.pi*self.initial_intensity*(antiderivative(1.0)-antiderivative(mu_in))
+    def opaque_disc_occultation(self,disc_radius,distance,radial_steps):
+        """
+            Flux of the limb darkened star hidden by an opaque disc of disc_radius at distance from the centre of the star.
+
+            The circles around the centre of the star which are entirely behind the disc are found with stellar_flux_within, the rest
+            of the overlap is integrated over radius (with radial_steps Gauss-Legendre points) as the intensity times the length of
+            the arc behind the disc. disc_radius and distance broadcast against each other.
+        """
+        nodes,weights=np.polynomial.legendre.leggauss(radial_steps)
+        #cosine spacing puts more points near both ends of the arcs, where their length changes fastest
+        phase=np.pi*(nodes+1)/2
+        inner=np.abs(distance-disc_radius)
+        outer=np.minimum(distance+disc_radius,1.0)
+        width=np.clip(outer-inner,0.0,None)
+        radius=inner[...,None]+width[...,None]*(1-np.cos(phase))/2
+        jacobian=width[...,None]*np.sin(phase)/2*np.pi/2
+        with np.errstate(divide="ignore",invalid="ignore"):
+            cos_half_arc=(radius**2+distance[...,None]**2-disc_radius[...,None]**2)/(2*radius*distance[...,None])
+        half_arc=np.arccos(np.clip(np.where(np.isnan(cos_half_arc),1.0,cos_half_arc),-1.0,1.0))
+        mu_in=np.sqrt(np.clip(1-radius**2,0.0,None))
+        intensity=self.initial_intensity*(1-self.limb_darkening_coeff_a*(1-mu_in)-self.limb_darkening_coeff_b*(1-mu_in)**2)
+        partial=np.sum(weights*jacobian*intensity*2*half_arc*radius,axis=-1)
+        covered=np.where(distance<disc_radius,self.stellar_flux_within(disc_radius-distance),0.0)
+        return covered+partial
+    def semianalytic_frame_occultation(self,current_planet_horizontal_positions,core_steps=24,radial_steps=48,tail_steps=32):
+        """
+            Flux of the star hidden by the core and dust tail at each planet position, see semianalytic_lightcurve.
+        """
+        current_planet_horizontal_positions=np.asarray(current_planet_horizontal_positions,dtype=float)
+        occultation=np.zeros(len(current_planet_horizontal_positions))
+        prr=self.planetary_radius
+        #only positions where the core or the tail is in front of the star are integrated
+        in_transit=np.nonzero((current_planet_horizontal_positions+prr>-1)&(current_planet_horizontal_positions-max(self.dust_tail_length,prr)<1))[0]
+        if prr<=0 or abs(self.planet_vertical_position)>=1+prr or len(in_transit)==0:
+            return occultation
+        occultation[in_transit]=self.semianalytic_transit_occultation(current_planet_horizontal_positions[in_transit],core_steps,radial_steps,tail_steps)
+        return occultation
+    def semianalytic_transit_occultation(self,current_planet_horizontal_positions,core_steps,radial_steps,tail_steps):
+        """
+            semianalytic_frame_occultation for planet positions which are all in transit.
+        """
+        x=current_planet_horizontal_positions[:,None]
+        occultation=np.zeros(len(x))
+        prr=self.planetary_radius
+        #core: an opacity of 1-log(s+1)/log(prr+1) at s from the centre is a stack of opaque discs of radius r with weight 1/((r+1)log(prr+1))
+        nodes,weights=np.polynomial.legendre.leggauss(core_steps)
+        disc_radius=prr*(nodes+1)/2
+        disc_weight=weights*prr/2/((disc_radius+1)*np.log(prr+1))
+        distance=np.sqrt(x**2+self.planet_vertical_position**2)
+        chunk=max(1,self.max_chunk_pixels//(core_steps*radial_steps))
+        for start in range(0,len(x),chunk):
+            occulted=self.opaque_disc_occultation(disc_radius[None,:],np.broadcast_to(distance[start:start+chunk],(len(distance[start:start+chunk]),core_steps)),radial_steps)
+            occultation[start:start+chunk]=occulted@disc_weight
+        #tail: the strip prr either side of the planet from the core back to dust_tail_length, clipped to the stellar chord at each height
+        nodes,weights=np.polynomial.legendre.leggauss(tail_steps)
+        offsets=np.concatenate([-prr*(nodes+1)/2,prr*(nodes+1)/2])
+        offset_weights=np.concatenate([weights,weights])*prr/2
+        ver=self.planet_vertical_position+offsets
+        chord=np.sqrt(np.clip(1-ver**2,0.0,None))
+        core_edge=np.sqrt(np.clip(prr**2-offsets**2,0.0,None))
+        hor_low=np.maximum(x-self.dust_tail_length,-chord)
+        hor_high=np.minimum(x-core_edge,chord)
+        width=np.clip(hor_high-hor_low,0.0,None)
+        I_vert=np.log(np.abs(offsets)+1)/np.log(prr+1)
+        chunk=max(1,self.max_chunk_pixels//(2*tail_steps**2))
+        for start in range(0,len(x),chunk):
+            hor=hor_low[start:start+chunk,:,None]+width[start:start+chunk,:,None]*(nodes+1)/2
+            with np.errstate(divide="ignore",invalid="ignore",over="ignore"):
+                I_tail=np.expm1((x[start:start+chunk,:,None]-hor)/self.decay_constant)/np.expm1(self.dust_tail_length/self.decay_constant)
+                transmission=np.minimum(np.sqrt(I_vert[:,None]**2+I_tail**2),1.0)
+            transmission=np.where(np.isnan(transmission),0.0,transmission)
+            mu_in=np.sqrt(np.clip(1-hor**2-ver[:,None]**2,0.0,None))
+            intensity=self.initial_intensity*(1-self.limb_darkening_coeff_a*(1-mu_in)-self.limb_darkening_coeff_b*(1-mu_in)**2)
+            occultation[start:start+chunk]+=np.sum(offset_weights[:,None]*weights*width[start:start+chunk,:,None]/2*intensity*(1-transmission),axis=(1,2))
+        return occultation
+    def semianalytic_lightcurve(self,t,core_steps=24,radial_steps=48,tail_steps=32):
+        """
+            Lightcurve of the CDE from 1D integrals rather than a pixel grid, fast and accurate for any planetary radius.
+
+            The core is treated as a disc of radius prr with the same log transmission profile as I_core_FUNC and the dust tail as a
+            strip prr either side of the planet from the core back to dust_tail_length, with the transmission of I_tail_FUNC (clipped
+            at 1). The core is integrated as a stack of opaque discs (core_steps discs, each found with radial_steps points, see
+            opaque_disc_occultation) and the tail with tail_steps points along and across each chord of the star, so the cost does
+            not depend on prr and a prr=0.01 core is resolved as well as a large one.
+
+            This follows the intended shapes of the core and tail, so it is not identical to the pixel lightcurves: each occulted
+            point simply transmits a fraction of the starlight (there is no squared tail term added to every pixel, and the core and
+            tail are centred on the planet's path). The lightcurve is normalised by the flux of the unocculted star.
+        """
+        current_planet_horizontal_positions=(np.asarray(t,dtype=float).ravel()-self.epoch_shift)*self.orbital_speed
+        stellar_flux=self.stellar_flux_within(1.0)
+        cde_lightcurve=1-self.semianalytic_frame_occultation(current_planet_horizontal_positions,core_steps,radial_steps,tail_steps)/stellar_flux
+        return cde_lightcurve.reshape(np.shape(t))
+    def batch_lightcurve(self,t,params,kind="full",frame_steps=50,n_workers=None):
+        """
+            Lightcurves for many parameter sets at once, e.g. every walker of an MCMC ensemble.
+            
+            params is an (N,9) array of (prr,dtr,dc,ipr,ldca,ldcb,t0,sma,per) and the result is an (N,len(t)) array of normalised
+            lightcurves of the given kind ("quick", "slice" or "full"). The initial intensity and the pixel grid are taken from this
+            model. The parameter sets are evaluated together in blocks of no more than max_chunk_pixels pixel intensities, and the
+            stellar images are shared between every parameter set with the same limb darkening coefficients.
+            
+            If n_workers is more than 1 the parameter sets are split across a pool of n_workers processes.
+        """
+        params=np.atleast_2d(np.asarray(params,dtype=float))
+        if params.ndim!=2 or params.shape[1]!=9:
+            raise ValueError("params must have shape (N,9) with columns (prr,dtr,dc,ipr,ldca,ldcb,t0,sma,per).")
+        t=np.asarray(t,dtype=float).ravel()
+        if n_workers is not None and n_workers>1:
+            param_blocks=[param_block for param_block in np.array_split(params,n_workers*self.tasks_per_worker) if len(param_block)]
+            with self.worker_pool(n_workers) as executor:
+                return np.concatenate(list(executor.map(_worker_batch_lightcurve,repeat(t),param_blocks,repeat(kind),repeat(frame_steps)))+[np.empty((0,len(t)))])
+        pixel_position_hor_range,pixel_position_ver_range=self.pixel_grid(kind,frame_steps)
+        limb_darkening_coeffs,limb_darkening_index=np.unique(params[:,4:6],axis=0,return_inverse=True)
+        stellar_maps=[]
+        for limb_darkening_coeff_a,limb_darkening_coeff_b in limb_darkening_coeffs:
+            limb_darkening_model=CDE_Modelling(ldca=limb_darkening_coeff_a,ldcb=limb_darkening_coeff_b,ii=self.initial_intensity)
+            limb_darkening_model.stellar_map_cache=self.stellar_map_cache
+            limb_darkening_model.statistics=self.statistics
+            stellar_maps.append(limb_darkening_model.stellar_map(kind,frame_steps)[0])
+        stellar_maps=np.array(stellar_maps)
+        pixels=stellar_maps[0].size
+        rows_per_chunk=max(1,self.max_chunk_pixels//(len(t)*pixels))
+        times_per_chunk=max(1,self.max_chunk_pixels//(rows_per_chunk*pixels))
+        cde_lightcurves=np.empty((len(params),len(t)))
+        with np.errstate(divide="ignore",invalid="ignore",over="ignore"):
+            for row_start in range(0,len(params),rows_per_chunk):
+                rows=slice(row_start,row_start+rows_per_chunk)
+                p=params[rows,:,None,None,None]
+                batch_model=CDE_Modelling(prr=p[:,0],dtr=p[:,1],dc=p[:,2],ipr=p[:,3],ii=self.initial_intensity,ldca=p[:,4],ldcb=p[:,5],t0=p[:,6],sma=p[:,7],per=p[:,8])
+                batch_model.statistics=self.statistics
+                stellar_pixel_intensity=stellar_maps[limb_darkening_index.ravel()[rows],None]
+                for time_start in range(0,len(t),times_per_chunk):
+                    times=slice(time_start,time_start+times_per_chunk)
+                    current_planet_horizontal_position=(t[None,times,None,None]-batch_model.epoch_shift)*batch_model.orbital_speed
+                    pixel_intensity=batch_model.pixel_intensity_array(stellar_pixel_intensity,current_planet_horizontal_position,pixel_position_hor_range,pixel_position_ver_range)
+                    cde_lightcurves[rows,times]=pixel_intensity.sum(axis=(2,3))
+        if kind=="quick":
+            delta_flux=cde_lightcurves.max(axis=1,keepdims=True)-cde_lightcurves.min(axis=1,keepdims=True)
+            cde_lightcurves=cde_lightcurves+delta_flux/(params[:,0,None]**2)-delta_flux
+        return cde_lightcurves/cde_lightcurves.max(axis=1,keepdims=True)
 
 
 """
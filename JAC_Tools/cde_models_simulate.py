@@ -190,6 +190,64 @@ class CDE_Modelling:
             cde_lightcurve.append(frame_intensity)
         cde_lightcurve=np.array(cde_lightcurve)/max(cde_lightcurve)
         return x_range, cde_lightcurve
+    def I_star_array(self,distance_ratio_from_stellar_centre):
+        """
+            I_star_prior*I_star_FUNC for an array of distance ratios.
+        """
+        mu_in=np.sqrt(np.clip(1-distance_ratio_from_stellar_centre**2,0,None))
+        I_ratio=1-self.limb_darkening_coeff_a*(1-mu_in)-self.limb_darkening_coeff_b*(1-mu_in)**2
+        return np.where(distance_ratio_from_stellar_centre<1,self.initial_intensity*I_ratio,0.0)
+    def pixel_intensity_components(self,current_planet_horizontal_position,pixel_position_hor,pixel_position_ver,stellar_pixel_intensity):
+        """
+            The star, core and tail terms of the pixel intensity for arrays of pixel positions, the same as the per pixel loops.
+
+            pixel_position_hor and pixel_position_ver broadcast against each other (and stellar_pixel_intensity), the pixel intensity
+            is star+core+tail.
+        """
+        tail_lower_bound=self.star_vertical_position-self.planetary_radius
+        tail_upper_bound=self.star_vertical_position+self.planetary_radius
+        in_tail=(current_planet_horizontal_position>pixel_position_hor)&(pixel_position_hor>=current_planet_horizontal_position-self.dust_tail_length)&(tail_lower_bound<pixel_position_ver)&(pixel_position_ver<tail_upper_bound)
+        r_antiprior=np.sqrt((self.planet_vertical_position-pixel_position_hor)**2+(current_planet_horizontal_position-pixel_position_ver)**2)
+        in_antiprior_core=(r_antiprior<self.planetary_radius)&(current_planet_horizontal_position<=pixel_position_hor)&(pixel_position_hor<=current_planet_horizontal_position+self.planetary_radius)
+        star=stellar_pixel_intensity*np.where(in_tail|in_antiprior_core,0.0,1.0)
+        with np.errstate(divide="ignore",invalid="ignore",over="ignore"):
+            r_core=np.sqrt((self.planet_vertical_position-pixel_position_ver)**2+(current_planet_horizontal_position-pixel_position_hor)**2)
+            in_core=(r_core<self.planetary_radius)&(current_planet_horizontal_position<=pixel_position_ver)&(pixel_position_ver<=current_planet_horizontal_position+self.planetary_radius)
+            distance_from_planetary_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(current_planet_horizontal_position-pixel_position_hor)**2)
+            I_core=stellar_pixel_intensity/np.log(self.planetary_radius+1)*np.log(distance_from_planetary_centre+1)
+            core=np.where(in_core,np.where(np.isnan(I_core),0.0,I_core),0.0)
+            distance_from_tail_centre=np.abs(self.planet_vertical_position-pixel_position_ver)
+            max_distance_from_tail_centre=abs(self.planet_vertical_position-tail_lower_bound)
+            I_tail=(np.exp(-pixel_position_hor/self.decay_constant)-np.exp(-current_planet_horizontal_position/self.decay_constant))/(np.exp(-(current_planet_horizontal_position-self.dust_tail_length)/self.decay_constant)-np.exp(-(current_planet_horizontal_position/self.decay_constant)))
+            I_vert=np.log(distance_from_tail_centre+1)/np.log(max_distance_from_tail_centre+1)
+            I_combine=np.sqrt(I_vert**2+I_tail**2)
+            I=stellar_pixel_intensity*np.where(I_combine>1.0,1.0,I_combine)
+        tail=np.where(np.isnan(I),0.0,I)**2
+        return star,core,tail
+    def render_frames(self,step_number=300,filename="cde_frames.npy",component="total"):
+        """
+            Images of the CDE crossing the frame, written to filename as a memory mapped float32 .npy array of shape (step_number,H,W).
+
+            The frame is resolution_height by resolution_width pixels (rounded up) with the pixel centres at half integers, and one image
+            is made for each planet position in x_range (the same as the lightcurves). component chooses the intensity to render, "total"
+            (the pixel intensity summed by the lightcurves) or one of its "star", "core" and "tail" terms. Each image is calculated in one
+            go and written straight to the file, so only a single frame is held in memory. Returns x_range and the memory map, load it
+            again with np.load(filename,mmap_mode="r").
+        """
+        components=("total","star","core","tail")
+        if component not in components:
+            raise ValueError("component must be one of %s, not %r."%(", ".join(components),component))
+        x_range=np.linspace(0,self.resolution_width,step_number)
+        pixel_position_hor=np.arange(int(np.ceil(self.resolution_width)))[np.newaxis,:]+0.5
+        pixel_position_ver=np.arange(int(np.ceil(self.resolution_height)))[:,np.newaxis]+0.5
+        distance_ratio_from_stellar_centre=np.sqrt((self.star_vertical_position-pixel_position_ver)**2+(self.star_horizontal_position-pixel_position_hor)**2)/self.stellar_radius
+        stellar_pixel_intensity=self.I_star_array(distance_ratio_from_stellar_centre)
+        frames=np.lib.format.open_memmap(filename,mode="w+",dtype=np.float32,shape=(step_number,pixel_position_ver.shape[0],pixel_position_hor.shape[1]))
+        for i,current_planet_horizontal_position in enumerate(x_range):
+            star,core,tail=self.pixel_intensity_components(current_planet_horizontal_position,pixel_position_hor,pixel_position_ver,stellar_pixel_intensity)
+            frames[i]={"total":star+core+tail,"star":star,"core":core,"tail":tail}[component]
+        frames.flush()
+        return x_range, frames
 
 
 """
@@ -204,4 +262,7 @@ plt.figure()
 plt.plot(x,y)
 #print(CDEM.resolution_width,CDEM.star_horizontal_position)
 plt.show()
+x,frames=CDEM.render_frames(step_number=100,filename="cde_frames.npy")
+plt.imshow(frames[50])
+plt.show()
 """
\ No newline at end of file
@@ -1,68 +1,540 @@
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice,product,repeat
 import numpy as np
+
+_worker_grid_search=None
+def _initialise_worker(grid_search_bytes):
+    """
+        Unpickle the GridSearch (and so the function) once in each worker process of the pool.
+    """
+    global _worker_grid_search
+    _worker_grid_search=pickle.loads(grid_search_bytes)
+def _worker_batch_errors(start,stop,steps,vectorized):
+    _worker_grid_search.reset_errors()
+    points=_worker_grid_search.grid_batch(start,stop,steps)
+    _worker_grid_search.update_errors(_worker_grid_search.evaluate_points(points,vectorized)-_worker_grid_search.R_true,points)
+    return _worker_grid_search.minimum_error,_worker_grid_search.minimum_parameters,_worker_grid_search.maximum_error,_worker_grid_search.maximum_parameters
+def _worker_point_errors(points,vectorized):
+    _worker_grid_search.reset_errors()
+    _worker_grid_search.update_errors(_worker_grid_search.evaluate_points(points,vectorized)-_worker_grid_search.R_true,points)
+    return _worker_grid_search.minimum_error,_worker_grid_search.minimum_parameters,_worker_grid_search.maximum_error,_worker_grid_search.maximum_parameters
+
+SAMPLING_METHODS=("sobol","halton","lhs","montecarlo")#"sobol" needs the optional scipy dependency, pip install JAC_Tools[sobol]
+
+def primes(n):
+    """
+        The first n prime numbers.
+    """
+    found=[]
+    candidate=2
+    while len(found)<n:
+        if all(candidate%prime for prime in found):
+            found.append(candidate)
+        candidate+=1
+    return found
+
+def radical_inverse(index,base):
+    """
+        The van der Corput radical inverse of an array of integers in the given base, the digits reflected about the decimal point.
+    """
+    index=np.array(index,dtype=np.int64)
+    result=np.zeros(len(index))
+    fraction=1.0/base
+    while np.any(index>0):
+        result+=fraction*(index%base)
+        index//=base
+        fraction/=base
+    return result
+
+def unit_samples(method,n_samples,dimensions,seed=None,batch_size=100000):
+    """
+        Generator of n_samples points in the unit hypercube, batch_size points at a time as (points,dimensions) arrays.
+
+        method is one of SAMPLING_METHODS:
+            "sobol": scrambled Sobol sequence, this needs scipy (scipy.stats.qmc).
+            "halton": Halton sequence in the first dimensions primes, randomly shifted (modulo 1) if a seed is given.
+            "lhs": Latin hypercube, each parameter has exactly one point in each of n_samples equal strata.
+            "montecarlo": uniform random points.
+        The same seed always gives the same points.
+    """
+    rng=np.random.default_rng(seed)
+    if method=="sobol":
+        try:
+            from scipy.stats import qmc
+        except ImportError as error:
+            raise ImportError("Sobol sampling needs scipy (scipy.stats.qmc), use method=\"halton\" without it.") from error
+        engine=qmc.Sobol(dimensions,scramble=True,seed=rng)
+        for start in range(0,n_samples,batch_size):
+            yield engine.random(min(batch_size,n_samples-start))
+    elif method=="halton":
+        bases=primes(dimensions)
+        shift=rng.random(dimensions) if seed is not None else np.zeros(dimensions)
+        for start in range(0,n_samples,batch_size):
+            index=np.arange(start+1,min(start+batch_size,n_samples)+1)
+            yield (np.column_stack([radical_inverse(index,base) for base in bases])+shift)%1
+    elif method=="lhs":
+        strata=[rng.permutation(n_samples) for i in range(dimensions)]
+        for start in range(0,n_samples,batch_size):
+            stop=min(start+batch_size,n_samples)
+            yield (np.column_stack([stratum[start:stop] for stratum in strata])+rng.random((stop-start,dimensions)))/n_samples
+    elif method=="montecarlo":
+        for start in range(0,n_samples,batch_size):
+            yield rng.random((min(batch_size,n_samples-start),dimensions))
+    else:
+        raise ValueError("Unknown sampling method %r, use \"grid\" or one of %s."%(method,", ".join(SAMPLING_METHODS)))
+
+def unit_points(method,steps,dimensions,seed=None,batch_size=100000):
+    """
+        Generator of points in the unit hypercube, batch_size at a time: the steps**dimensions grid for method="grid" (in the same order
+        as GridSearch.grid_batch), otherwise steps points from unit_samples.
+    """
+    if method!="grid":
+        yield from unit_samples(method,steps,dimensions,seed,batch_size)
+        return
+    axis=np.linspace(0,1,steps)
+    n_points=steps**dimensions
+    for start in range(0,n_points,batch_size):
+        yield np.column_stack([axis[index] for index in np.unravel_index(np.arange(start,min(start+batch_size,n_points)),(steps,)*dimensions)])
+
+def catalogue_errorpropagation(values,value_errors,function,steps,method="grid",seed=None,batch_size=100000,chunk_size=10000):
+    """
+        Propagate the errors of a whole catalogue of objects through a vectorized function, returns arrays of (min,max,R).
+
+        values has shape (n_objects,n_params) and value_errors (n_objects,n_params,2), the (lower,upper) errors of each value as in the
+        value_errors_in of GridSearch. The function is called in the same way as GridSearch with vectorized=True, with a list of an array
+        for each parameter (or a single array for one parameter), here each array has shape (objects,points).
+
+        The search is the grid of errorpropagation (steps along each parameter) or one of SAMPLING_METHODS (steps points in total), the same
+        points are used for every object with the same seed. The objects are worked through chunk_size at a time and the points so that
+        at most batch_size function values are held at once. Where the function never decreases (or increases) the min (or max) is nan
+        rather than raising a ValueError.
+    """
+    values=np.asarray(values,dtype=float)
+    value_errors=np.asarray(value_errors,dtype=float)
+    if values.ndim==1:
+        values=values[:,np.newaxis]
+    if value_errors.ndim==2:
+        value_errors=value_errors[:,np.newaxis]
+    if value_errors.shape!=values.shape+(2,):
+        raise ValueError("value_errors must have shape (n_objects,n_params,2) to match values %s, not %s."%(values.shape,value_errors.shape))
+    n_objects,n_params=values.shape
+    minimum_error=np.empty(n_objects)
+    maximum_error=np.empty(n_objects)
+    R_true=np.empty(n_objects)
+    for start in range(0,n_objects,chunk_size):
+        stop=min(start+chunk_size,n_objects)
+        chunk_values=values[start:stop]
+        R=np.broadcast_to(function(chunk_values[:,0] if n_params==1 else [chunk_values[:,i] for i in range(n_params)]),(stop-start,))
+        lower=(chunk_values+value_errors[start:stop,:,0])[:,np.newaxis,:]
+        width=(value_errors[start:stop,:,1]-value_errors[start:stop,:,0])[:,np.newaxis,:]
+        chunk_minimum=np.full(stop-start,np.inf)
+        chunk_maximum=np.full(stop-start,-np.inf)
+        for unit in unit_points(method,steps,n_params,seed,max(1,batch_size//(stop-start))):
+            points=lower+unit*width
+            columns=[points[:,:,i] for i in range(n_params)]
+            deviation=np.broadcast_to(function(columns[0] if n_params==1 else columns),points.shape[:2])-R[:,np.newaxis]
+            chunk_minimum=np.minimum(chunk_minimum,np.min(deviation,axis=1,initial=np.inf,where=deviation<0))
+            chunk_maximum=np.maximum(chunk_maximum,np.max(deviation,axis=1,initial=-np.inf,where=deviation>0))
+        minimum_error[start:stop]=np.where(np.isinf(chunk_minimum),np.nan,chunk_minimum)
+        maximum_error[start:stop]=np.where(np.isinf(chunk_maximum),np.nan,chunk_maximum)
+        R_true[start:stop]=R
+    return minimum_error,maximum_error,R_true
+
+def split_catalogue_rows(rows):
+    """
+        Split catalogue rows of n values followed by the n (lower,upper) error pairs into values and value_errors.
+    """
+    rows=np.atleast_2d(np.asarray(rows,dtype=float))
+    if rows.shape[1]%3:
+        raise ValueError("Each catalogue row must hold the values followed by a (lower,upper) error pair for each, %d columns does not."%rows.shape[1])
+    n_params=rows.shape[1]//3
+    return rows[:,:n_params],rows[:,n_params:].reshape(len(rows),n_params,2)
+
+def catalogue_rows(path,chunk_size=10000,header=False,delimiter=","):
+    """
+        Generator of (values,value_errors) from a catalogue file chunk_size objects at a time.
+
+        A .npy file is opened as a memory map, any other file is read as delimited text with blank lines and lines starting with #
+        ignored (and the first line if header is True). Each row is the values followed by the (lower,upper) error pair of each value,
+        so v1,v2,lower1,upper1,lower2,upper2 for two parameters.
+    """
+    if path.endswith(".npy"):
+        catalogue=np.load(path,mmap_mode="r")
+        for start in range(0,len(catalogue),chunk_size):
+            yield split_catalogue_rows(catalogue[start:start+chunk_size])
+        return
+    with open(path) as catalogue_file:
+        if header:
+            next(catalogue_file,None)
+        while True:
+            lines=list(islice(catalogue_file,chunk_size))
+            if not lines:
+                return
+            rows=[[float(item) for item in line.split(delimiter)] for line in lines if line.strip() and not line.lstrip().startswith("#")]
+            if rows:
+                yield split_catalogue_rows(rows)
+
+def catalogue_length(path,header=False):
+    """
+        The number of objects in a catalogue file.
+    """
+    if path.endswith(".npy"):
+        return len(np.load(path,mmap_mode="r"))
+    with open(path) as catalogue_file:
+        if header:
+            next(catalogue_file,None)
+        return sum(1 for line in catalogue_file if line.strip() and not line.lstrip().startswith("#"))
+
+def catalogue_errorpropagation_file(input_path,output_path,function,steps,method="grid",seed=None,batch_size=100000,chunk_size=10000,header=False,delimiter=","):
+    """
+        Propagate the errors of a catalogue read from input_path and write (min,max,R) for each object to output_path.
+
+        The catalogue is read and the results written chunk_size objects at a time (see catalogue_rows and catalogue_errorpropagation),
+        so the catalogue is never held in memory. A .npy output is written as a memory map of shape (n_objects,3), anything else as
+        delimited text with a header line. Returns the number of objects.
+    """
+    if output_path.endswith(".npy"):
+        output=np.lib.format.open_memmap(output_path,mode="w+",dtype=np.float64,shape=(catalogue_length(input_path,header),3))
+    else:
+        output=open(output_path,"w")
+        output.write(delimiter.join(("minimum_error","maximum_error","R_true"))+"\n")
+    n_objects=0
+    try:
+        for values,value_errors in catalogue_rows(input_path,chunk_size,header,delimiter):
+            results=np.column_stack(catalogue_errorpropagation(values,value_errors,function,steps,method,seed,batch_size,chunk_size))
+            if isinstance(output,np.memmap):
+                output[n_objects:n_objects+len(results)]=results
+            else:
+                np.savetxt(output,results,delimiter=delimiter)
+            n_objects+=len(results)
+    finally:
+        if isinstance(output,np.memmap):
+            output.flush()
+        else:
+            output.close()
+    return n_objects
+
 class GridSearch:
     """
         This class is designed to propagate the errors on a function using a grid search method.
-        
+
         It requires a function to be assigned to the class, as well as the input parameters and errors for that function.
     """
     def __init__(self,values_in,value_errors_in,function_in):
         """
             Initialize the class, assign the function to the class attributes and assign the variables to class parameters.
         """
-        self.minimum_error=[]
-        self.maximum_error=[]
         self.true_values=tuple(values_in)
         self.true_errors=value_errors_in
-        self.temp_values=values_in
         self.function=function_in
-    def errorpropagation(self,steps):
+        self.R_true=None
+        self.evaluations=0
+        self.convergence=None
+        self.reset_errors()
+    tasks_per_worker=4#number of pieces of work given to each process when workers is set
+    optimize_starts=3#number of box vertices each local search of method="optimize" is started from
+    optimize_tolerance=1e-6#method="optimize" stops when the search step is below this fraction of each error
+    def errorpropagation(self,steps,vectorized=False,batch_size=100000,return_parameters=False,workers=None,method="grid",seed=None):
         """
-            Decide which propagation method is needed depending on whether there are single or multiple variables.
+            Propagate the errors on the function for single or multiple variables, returns (min,max,R).
+
+            The grid is walked batch_size points at a time, keeping only the most negative and most positive deviation from the
+            true value, so the memory used does not depend on the number of dimensions. If the function works on numpy arrays set
+            vectorized=True and it is called once for each batch (see errorpropagation_vectorized), which is much faster than
+            calling the function for every grid point.
+
+            If return_parameters is True the parameters which gave the min and max are returned as well, (min,max,R,min_parameters,max_parameters).
+
+            For expensive functions set workers to share the grid across a pool of processes (see errorpropagation_parallel), the result
+            is identical to the serial one.
+
+            The grid needs steps**n evaluations for n parameters, for more than a few parameters set method to one of SAMPLING_METHODS
+            ("sobol","halton","lhs","montecarlo") and steps is then the total number of evaluations (see errorpropagation_sampled),
+            seed makes the random methods reproducible. For smooth functions method="optimize" searches for the extremes directly
+            (see errorpropagation_optimize) and steps is not used. self.evaluations is the number of times the function was evaluated.
         """
-        if len(self.true_values)==1:
-            self.true_values=self.true_values[0]
-            return self.errorpropagation_single(steps)
+        if method=="optimize":
+            self.errorpropagation_optimize(vectorized)
+        elif method=="grid":
+            if workers is not None and workers>1:
+                self.errorpropagation_parallel(steps,workers,vectorized,batch_size)
+            else:
+                self.errorpropagation_grid(steps,vectorized,batch_size)
         else:
-            return self.errorpropagation_multiple(steps)
+            self.errorpropagation_sampled(steps,method,seed,vectorized,batch_size,workers)
+        if return_parameters:
+            return self.minimum_error,self.maximum_error,self.R_true,self.minimum_parameters,self.maximum_parameters
+        return self.minimum_error,self.maximum_error,self.R_true
     def errorpropagation_multiple(self,steps):
         """
             Propagate the errors on a function for multiple inputs.
         """
-        self.loop_rec(0,steps)
-        return min(self.minimum_error),max(self.maximum_error),self.function(self.true_values)
-    def loop_rec(self,n,steps):
+        return self.errorpropagation(steps)
+    def errorpropagation_single(self,steps):
+        """
+            Propagate the errors on a function for a single parameter.
+        """
+        return self.errorpropagation(steps)
+    def errorpropagation_vectorized(self,steps,batch_size=100000):
+        """
+            Propagate the errors on a function which works on numpy arrays, for single or multiple inputs.
+
+            For multiple inputs the function is given a list with an array for each parameter (so variables[0] is an array of the first
+            parameter), for a single input it is given an array. Returns the same (min,max,R) as errorpropagation.
+        """
+        return self.errorpropagation(steps,True,batch_size)
+    def reset_errors(self):
+        """
+            Forget the errors from any previous propagation.
+        """
+        self.minimum_error=None
+        self.maximum_error=None
+        self.minimum_parameters=None
+        self.maximum_parameters=None
+    def true_function_value(self):
+        """
+            The function at the true values, a single input is given as a number rather than a tuple.
+        """
+        if len(self.true_values)==1:
+            return self.function(self.true_values[0])
+        return self.function(self.true_values)
+    def grid_axes(self,steps):
+        """
+            The values of each parameter along the grid, from value+error[0] to value+error[1].
+        """
+        return [np.linspace(value+ers[0],value+ers[1],steps) for value,ers in zip(self.true_values,self.true_errors)]
+    def grid_batch(self,start,stop,steps):
+        """
+            The grid points with flat index start to stop as a (points,dimensions) array.
+
+            The points are in the same order as the original recursive loop, the first parameter changes slowest.
+        """
+        axes=self.grid_axes(steps)
+        grid_index=np.unravel_index(np.arange(start,stop),(steps,)*len(axes))
+        return np.column_stack([axis[index] for axis,index in zip(axes,grid_index)])
+    def grid_points(self,steps,batch_size):
+        """
+            Generator of the grid of input parameters, batch_size points at a time as (points,dimensions) arrays.
+        """
+        n_points=steps**len(self.true_values)
+        for start in range(0,n_points,batch_size):
+            yield self.grid_batch(start,min(start+batch_size,n_points),steps)
+    def evaluate_points(self,points,vectorized):
+        """
+            The function at each row of points.
+
+            A single input is given as a number (or an array of numbers when vectorized), multiple inputs as a list of values
+            (or a list of arrays when vectorized).
+        """
+        single=points.shape[1]==1
+        if vectorized:
+            columns=[points[:,i] for i in range(points.shape[1])]
+            return np.broadcast_to(self.function(columns[0] if single else columns),(len(points),))
+        return np.array([self.function(point[0] if single else list(point)) for point in points])
+    def merge_errors(self,minimum_error,minimum_parameters,maximum_error,maximum_parameters):
+        """
+            Update the running most negative and most positive deviation, and the parameters which gave them.
+
+            Ties keep the earlier point, so merging batches in grid order gives the same result however the grid was split.
+        """
+        if minimum_error is not None and (self.minimum_error is None or minimum_error<self.minimum_error):
+            self.minimum_error=minimum_error
+            self.minimum_parameters=minimum_parameters
+        if maximum_error is not None and (self.maximum_error is None or maximum_error>self.maximum_error):
+            self.maximum_error=maximum_error
+            self.maximum_parameters=maximum_parameters
+    def update_errors(self,deviation,points):
+        """
+            Update the running errors with the deviations of a batch of points from the true value.
+        """
+        minimum_error=minimum_parameters=maximum_error=maximum_parameters=None
+        negative=np.nonzero(deviation<0)[0]
+        if len(negative):
+            i=negative[np.argmin(deviation[negative])]
+            minimum_error,minimum_parameters=deviation[i],points[i].copy()
+        positive=np.nonzero(deviation>0)[0]
+        if len(positive):
+            i=positive[np.argmax(deviation[positive])]
+            maximum_error,maximum_parameters=deviation[i],points[i].copy()
+        self.merge_errors(minimum_error,minimum_parameters,maximum_error,maximum_parameters)
+    def check_errors(self):
+        if self.minimum_error is None or self.maximum_error is None:
+            raise ValueError("The function does not both increase and decrease over the grid, so the errors cannot be propagated.")
+    def errorpropagation_grid(self,steps,vectorized=False,batch_size=100000):
         """
             The primary function.
-            
-            This recursive loop creates a grid of input parameters based on the number of dimensions and steps of the input.
-        """
-        if n <= len(self.true_errors)-1:
-            ers=self.true_errors[n]
-            x=np.linspace(self.true_values[n]+ers[0],self.true_values[n]+ers[1],steps)
-            for i in x:
-                self.temp_values[n]=i
-                self.loop_rec( n + 1,steps)
+
+            Walks the grid of input parameters in batches, comparing the function at each point with the function at the true values.
+        """
+        self.reset_errors()
+        self.R_true=self.true_function_value()
+        self.evaluations=1+steps**len(self.true_values)
+        for points in self.grid_points(steps,batch_size):
+            self.update_errors(self.evaluate_points(points,vectorized)-self.R_true,points)
+        self.check_errors()
+    def loop_rec(self,n,steps):
+        """
+            Kept for code written against the original recursive grid search, walks the whole grid with errorpropagation_grid.
+
+            n was the parameter the recursion had reached and must be 0. The errors are left in minimum_error and maximum_error.
+        """
+        if n!=0:
+            raise ValueError("loop_rec now walks the whole grid, so n must be 0.")
+        self.errorpropagation_grid(steps)
+    def pickled(self):
+        """
+            This GridSearch pickled to send to worker processes.
+
+            Functions which the pickle module cannot handle (lambdas, functions defined inside other functions or in an interactive
+            session) are pickled with cloudpickle if it is installed.
+        """
+        try:
+            return pickle.dumps(self)
+        except (pickle.PicklingError,AttributeError,TypeError) as error:
+            try:
+                import cloudpickle
+            except ImportError:
+                raise TypeError("The function cannot be pickled for the worker processes (%s), define it at the top level of a module or install cloudpickle."%error) from error
+            return cloudpickle.dumps(self)
+    def errorpropagation_parallel(self,steps,workers,vectorized=False,batch_size=100000):
+        """
+            Walks the grid across a pool of worker processes.
+
+            The grid is split into ranges of at most batch_size points (smaller if needed to give each worker tasks_per_worker ranges),
+            each worker finds the errors for its ranges and these are merged in grid order, so the result is identical to errorpropagation_grid.
+            The GridSearch and function are sent to each worker once.
+        """
+        self.reset_errors()
+        self.R_true=self.true_function_value()
+        n_points=steps**len(self.true_values)
+        self.evaluations=1+n_points
+        task_size=max(1,min(batch_size,-(-n_points//(workers*self.tasks_per_worker))))
+        starts=list(range(0,n_points,task_size))
+        stops=[min(start+task_size,n_points) for start in starts]
+        with ProcessPoolExecutor(max_workers=workers,initializer=_initialise_worker,initargs=(self.pickled(),)) as executor:
+            for batch_errors in executor.map(_worker_batch_errors,starts,stops,repeat(steps),repeat(vectorized)):
+                self.merge_errors(*batch_errors)
+        self.check_errors()
+    def sample_points(self,n_samples,method,seed=None,batch_size=100000):
+        """
+            Generator of n_samples points sampled within the errors, batch_size points at a time as (points,dimensions) arrays.
+
+            Each parameter is sampled between value+error[0] and value+error[1] (so asymmetric errors are kept), with the points
+            spread over the box by unit_samples.
+        """
+        lower=np.array([value+ers[0] for value,ers in zip(self.true_values,self.true_errors)],dtype=float)
+        upper=np.array([value+ers[1] for value,ers in zip(self.true_values,self.true_errors)],dtype=float)
+        for unit in unit_samples(method,n_samples,len(self.true_values),seed,batch_size):
+            yield lower+unit*(upper-lower)
+    def errorpropagation_sampled(self,n_samples,method,seed=None,vectorized=False,batch_size=100000,workers=None):
+        """
+            Propagate the errors with a fixed budget of n_samples evaluations spread over the errors by method (see unit_samples).
+
+            The cost depends only on n_samples, not on the number of parameters. As the extremes can only be reached at sample points
+            the errors found are never larger than the true ones, self.convergence holds the running errors after each batch
+            ("evaluations","minimum_error","maximum_error") and "relative_change", the largest relative change in either error over the
+            second half of the samples, which is small once more samples are unlikely to change the result.
+        """
+        self.reset_errors()
+        self.R_true=self.true_function_value()
+        self.evaluations=1+n_samples
+        half=n_samples//2
+        #the points are split at half way so the errors after half of the samples are recorded
+        batches=self.split_batches(self.sample_points(n_samples,method,seed,batch_size),half)
+        history={"evaluations":[],"minimum_error":[],"maximum_error":[]}
+        if workers is not None and workers>1:
+            with ProcessPoolExecutor(max_workers=workers,initializer=_initialise_worker,initargs=(self.pickled(),)) as executor:
+                batches=list(batches)
+                for points,batch_errors in zip(batches,executor.map(_worker_point_errors,batches,repeat(vectorized))):
+                    self.merge_errors(*batch_errors)
+                    self.record_convergence(history,len(points))
         else:
-            R_temp=self.function(self.temp_values)
-            R_true=self.function(self.true_values)
-            if R_temp-R_true>0:
-                self.maximum_error.append(R_temp-R_true)
-            if R_temp-R_true<0:
-                self.minimum_error.append(R_temp-R_true)
-    def errorpropagation_single(self,steps):
+            for points in batches:
+                self.update_errors(self.evaluate_points(points,vectorized)-self.R_true,points)
+                self.record_convergence(history,len(points))
+        half_index=history["evaluations"].index(half) if half in history["evaluations"] else None
+        changes=[]
+        for key in ("minimum_error","maximum_error"):
+            final=history[key][-1] if history[key] else None
+            at_half=history[key][half_index] if half_index is not None else None
+            if final is None or at_half is None:
+                changes.append(np.inf)
+            else:
+                changes.append(abs(final-at_half)/abs(final))
+        history["relative_change"]=max(changes)
+        self.convergence=history
+        self.check_errors()
+    def split_batches(self,batches,split):
         """
-            Propagate the errors on a function for a single parameter.
+            Generator of the batches with any batch which spans point number split cut in two there.
+        """
+        start=0
+        for points in batches:
+            if start<split<start+len(points):
+                yield points[:split-start]
+                yield points[split-start:]
+            else:
+                yield points
+            start+=len(points)
+    def record_convergence(self,history,n_points):
+        """
+            Add the running errors after another n_points evaluations to history.
+        """
+        history["evaluations"].append((history["evaluations"][-1] if history["evaluations"] else 0)+n_points)
+        history["minimum_error"].append(self.minimum_error)
+        history["maximum_error"].append(self.maximum_error)
+    def error_box(self):
+        """
+            The lower and upper limits of each parameter, whichever order the errors are given in.
+        """
+        limits=np.array([(value+ers[0],value+ers[1]) for value,ers in zip(self.true_values,self.true_errors)],dtype=float)
+        return limits.min(axis=1),limits.max(axis=1)
+    def evaluate_search_points(self,points,vectorized):
+        """
+            The function at each row of points, counting the evaluations and keeping the running errors up to date.
+        """
+        values=self.evaluate_points(points,vectorized)
+        self.evaluations+=len(points)
+        self.update_errors(values-self.R_true,points)
+        return values
+    def pattern_search(self,point,value,sign,lower,upper,vectorized):
+        """
+            Bounded compass search from point for the minimum (sign=1) or maximum (sign=-1) of the function.
+
+            Each iteration tries a step up and down along every parameter (clipped to the box), moving to the best point if it is an
+            improvement and halving the steps if not, until the steps are below optimize_tolerance of the box.
+        """
+        free=np.nonzero(upper>lower)[0]
+        step=(upper-lower)/2
+        while len(free) and np.any(step[free]>self.optimize_tolerance*(upper-lower)[free]):
+            moves=np.zeros((2*len(free),len(point)))
+            moves[np.arange(len(free)),free]=step[free]
+            moves[len(free)+np.arange(len(free)),free]=-step[free]
+            trials=np.clip(point+moves,lower,upper)
+            values=self.evaluate_search_points(trials,vectorized)
+            best=np.argmin(sign*values)
+            if sign*values[best]<sign*value:
+                point,value=trials[best],values[best]
+            else:
+                step=step/2
+    def errorpropagation_optimize(self,vectorized=False):
+        """
+            Find the extremes of the function over the box of errors with a local search rather than a grid.
+
+            The function is evaluated at the 2**n vertices of the box, then a bounded pattern search (see pattern_search) is run from the
+            optimize_starts lowest vertices for the minimum and the optimize_starts highest for the maximum. For smooth or monotonic
+            functions this needs far fewer evaluations than the grid, but like any local search it can miss an extreme inside the box
+            of a function with several peaks.
         """
-        ers=self.true_errors[0]
-        x=np.linspace(np.array(self.true_values)+ers[0],np.array(self.true_values)+ers[1],steps)
-        for i in x:
-            temp=i
-            R_temp=self.function(temp)
-            R_true=self.function(self.true_values)
-            if R_temp-R_true>0:
-                self.maximum_error.append(R_temp-R_true)
-            if R_temp-R_true<0:
-                self.minimum_error.append(R_temp-R_true)
-        R=self.function(self.true_values)
-        return min(self.minimum_error),max(self.maximum_error),R
-        
+        self.reset_errors()
+        self.R_true=self.true_function_value()
+        self.evaluations=1
+        lower,upper=self.error_box()
+        vertices=np.array(list(product(*zip(lower,upper))))
+        values=self.evaluate_search_points(vertices,vectorized)
+        order=np.argsort(values,kind="stable")
+        for sign,starts in ((1,order[:self.optimize_starts]),(-1,order[::-1][:self.optimize_starts])):
+            for i in starts:
+                self.pattern_search(vertices[i],values[i],sign,lower,upper,vectorized)
+        self.check_errors()
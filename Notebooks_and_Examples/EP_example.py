@@ -23,3 +23,18 @@ print(lot)
 GS=ep.GridSearch(truev_rad,er_rad,stellar_radius)
 lot=GS.errorpropagation(100)
 print(lot)
+#stellar_radius works on numpy arrays, so the whole grid can be evaluated at once
+GS=ep.GridSearch(truev_rad,er_rad,stellar_radius)
+lot=GS.errorpropagation(100,vectorized=True)
+print(lot)
+#with many parameters sample a fixed number of points instead of the full grid
+lot=GS.errorpropagation(2000,vectorized=True,method="lhs",seed=42)
+print(lot,GS.convergence["relative_change"])
+#or search for the extremes directly, which needs far fewer evaluations for smooth functions
+lot=GS.errorpropagation(None,vectorized=True,method="optimize")
+print(lot,GS.evaluations)
+#a whole catalogue of stars at once, values has shape (n_objects,n_params) and the errors (n_objects,n_params,2)
+catalogue_values=np.array([truev_rad,[120*Lsun,5200]])
+catalogue_errors=np.array([er_rad,[(20,-20),(85,-85)]])
+minimum,maximum,R=ep.catalogue_errorpropagation(catalogue_values,catalogue_errors,stellar_radius,100)
+print(minimum,maximum,R)
@@ -7,4 +7,6 @@ setup(name='JAC_Tools',
     author='Joseph Cooper',
     author_email='joseph.cooper@open.ac.uk',
     packages=['JAC_Tools'],
+    install_requires=['numpy'],
+    extras_require={'sobol':['scipy']},
     zip_safe=False)
\ No newline at end of file